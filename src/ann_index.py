@@ -2,6 +2,7 @@ import hnswlib
 import psutil
 
 from s3 import  bucket
+import index_artifact
 
 from loguru import logger
 from sqlmodel import Session, select
@@ -33,12 +34,13 @@ with Session(engine) as session:
 filename = "index-%s-%d.hnsf" % (ST_MODEL_NAME, count)
 hnsw_index.save_index(filename)
 
-objkey = f"massgpt/ann-index/{ST_MODEL_NAME}-{count}.hnsw"
-bucket.upload_file(filename, objkey)
+# the index is stored as a compressed, checksummed artifact; its manifest is the index object
+manifest_key = index_artifact.upload(bucket, filename, f"massgpt/ann-index/{ST_MODEL_NAME}-{count}")
 
 with Session(engine) as session:
-    ix = HnswIndex(collection = ST_MODEL_NAME,
-                   count      = count,
-                   objkey     = objkey)
+    ix = HnswIndex(collection   = ST_MODEL_NAME,
+                   count        = count,
+                   objkey       = manifest_key,
+                   manifest_key = manifest_key)
     session.add(ix)
     session.commit()
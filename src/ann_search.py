@@ -6,6 +6,9 @@ from sentence_transformers import SentenceTransformer
 from sqlmodel import Session, select
 import psutil
 import  hn_summary_db
+from s3 import bucket
+import index_artifact
+from exceptions import IndexSnapshotNotFound
 
 CPU_COUNT = psutil.cpu_count()
 
@@ -13,8 +16,28 @@ CPU_COUNT = psutil.cpu_count()
 ST_MODEL_NAME   =  'multi-qa-mpnet-base-dot-v1'
 st_model        =  SentenceTransformer(ST_MODEL_NAME)
 
+
+def fetch_index() -> str:
+    """
+    download the latest index snapshot of the collection, returning the local filename.
+    Snapshots stored as artifacts are verified; older snapshots are raw index files at objkey.
+    raises IndexSnapshotNotFound if the collection has no snapshot
+    """
+    with Session(engine) as session:
+        ix = session.exec(select(HnswIndex).where(HnswIndex.collection == ST_MODEL_NAME)
+                                           .order_by(HnswIndex.id.desc())).first()
+    if ix is None:
+        raise IndexSnapshotNotFound(f"no index snapshot of {ST_MODEL_NAME}; build one with ann_index.py")
+    filename = "index-%s-%d.hnsf" % (ST_MODEL_NAME, ix.count)
+    if ix.manifest_key:
+        index_artifact.download(bucket, ix.manifest_key, filename)
+    else:
+        bucket.download_file(ix.objkey, filename)
+    return filename
+
+
 hnsw_ix = hnswlib.Index(space='cosine', dim=768)
-hnsw_ix.load_index('index-multi-qa-mpnet-base-dot-v1-0.hnsf', max_elements=20000)
+hnsw_ix.load_index(fetch_index(), max_elements=20000)
 hnsw_ix.set_ef(1000)
 
 STORY_SOURCES = [EmbeddingSource.hn_story_summary, EmbeddingSource.hn_story_title]
@@ -0,0 +1,79 @@
+"""
+Benchmark the html text extraction backends over the saved page corpus in bench/pages.
+
+For each page the readability summary is computed once, then each backend extracts
+text from it repeatedly.  Reports throughput per backend and checks that the lxml
+output matches the bs4 output (after whitespace normalization).
+
+usage: python bench/bench_extract.py [--repeat N] [--scale N]
+
+--scale repeats the body of each summary N times to simulate very large pages.
+"""
+
+import os
+import re
+import sys
+import argparse
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from readability import Document
+from extract import extract_text_from_html
+
+PAGES_DIR = os.path.join(os.path.dirname(__file__), "pages")
+BACKENDS = ["bs4", "lxml"]
+
+
+def load_corpus(scale : int) -> dict[str, str]:
+    corpus = {}
+    for fn in sorted(os.listdir(PAGES_DIR)):
+        if not fn.endswith(".html"):
+            continue
+        with open(os.path.join(PAGES_DIR, fn), encoding="utf-8") as f:
+            summary = Document(f.read()).summary()
+        if scale > 1:
+            m = re.search(r"<body>(.*)</body>", summary, re.S)
+            if m:
+                summary = summary[:m.start(1)] + m.group(1)*scale + summary[m.end(1):]
+        corpus[fn] = summary
+    return corpus
+
+
+def normalize(text : str) -> str:
+    return " ".join(text.split())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--scale",  type=int, default=1)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.scale)
+    total_bytes = sum(len(c) for c in corpus.values())
+    print(f"{len(corpus)} pages, {total_bytes/1024:.1f} KB of summary html, repeat {args.repeat}")
+
+    outputs = {}
+    for backend in BACKENDS:
+        t0 = perf_counter()
+        for i in range(args.repeat):
+            for fn, content in corpus.items():
+                outputs[(backend, fn)] = extract_text_from_html(content, backend=backend)
+        dt = perf_counter() - t0
+        print(f"{backend:5}  {dt/args.repeat*1000:8.2f} ms/pass  {total_bytes*args.repeat/dt/1e6:8.2f} MB/s")
+
+    mismatches = 0
+    for fn in corpus:
+        a = normalize(outputs[("bs4", fn)])
+        b = normalize(outputs[("lxml", fn)])
+        if a != b:
+            mismatches += 1
+            i = next((i for i, (x, y) in enumerate(zip(a, b)) if x != y), min(len(a), len(b)))
+            print(f"MISMATCH {fn} at char {i}:\n  bs4:  {a[i-40:i+40]!r}\n  lxml: {b[i-40:i+40]!r}")
+    print(f"parity: {len(corpus)-mismatches}/{len(corpus)} pages match")
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+Microbenchmarks for the prompt assembly hot path.
+
+Each case is timed as the median seconds per call over several rounds and compared
+against the saved baseline in bench/baseline.json.  Exits non-zero if any case is
+slower than its baseline by more than the regression threshold.
+
+usage: python bench/microbench.py [--save] [--threshold 0.25] [--rounds 5] [case ...]
+
+--save writes the current timings as the new baseline, together with a description
+of the machine they were measured on.  Timings are only comparable on the same
+machine: when the baseline was saved on a different machine the comparison is
+reported but regressions don't fail the run.  Save a baseline on the machine you
+compare on.
+
+The LLM call is stubbed out and no database access is made.  The tokenizer is
+loaded before timing starts.
+"""
+
+import os
+import sys
+import json
+import random
+import platform
+import argparse
+import statistics
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# massgpt reads this config at import; none of it is used by the benchmarks
+for var in ["OPENAI_API_KEY", "MASSGPT_POSTGRES_HOST", "MASSGPT_POSTGRES_USER", "MASSGPT_POSTGRES_PASS"]:
+    os.environ.setdefault(var, "microbench")
+
+from loguru import logger
+from tokenizer import token_len
+from subprompt import SubPrompt
+from extract import extract_text_from_html
+from scheduler import scheduler
+from models import Message
+import massgpt
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+PAGES_DIR     = os.path.join(os.path.dirname(__file__), "pages")
+
+random.seed(0)
+WORDS = "the quick brown fox jumps over a lazy dog while users send messages about models prompts and tokens".split()
+
+def words(n : int) -> str:
+    return " ".join(random.choice(WORDS) for i in range(n))
+
+MESSAGE   = words(40)
+TEXT_1K   = words(200)
+TEXT_65K  = words(13000)[:65535]
+SP_A      = SubPrompt(TEXT_1K)
+SP_B      = SubPrompt(MESSAGE)
+SP_65K_TOKENS = token_len(TEXT_65K)
+
+def message_subprompt(i : int) -> massgpt.MessageSubPrompt:
+    return massgpt.MessageSubPrompt.from_msg(Message(id=i, user_id=i % 50, text=words(random.randint(5, 60))))
+
+MESSAGES = [message_subprompt(i) for i in range(400)]
+
+def full_context() -> massgpt.Context:
+    context = massgpt.Context()
+    for sub in MESSAGES:
+        context.add(sub)
+    return context
+
+CONTEXT = full_context()
+USER_MSG = message_subprompt(1000)
+
+with open(os.path.join(PAGES_DIR, sorted(os.listdir(PAGES_DIR))[0]), encoding="utf-8") as f:
+    from readability import Document
+    HTML_SUMMARY = Document(f.read()).summary()
+
+
+# stub out the llm call and the api quotas
+massgpt.msg_response_task._completion = lambda prompt, max_completion_tokens: "stub"
+scheduler.requests_per_minute = scheduler.tokens_per_minute = 10**12
+
+
+def truncate_65k():
+    SubPrompt(TEXT_65K, tokens=SP_65K_TOKENS).truncate(3000)
+
+def context_add_evict():
+    CONTEXT.add(MESSAGES[random.randrange(len(MESSAGES))])
+
+
+CASES = {
+    "token_len_message"       : lambda: token_len(MESSAGE),
+    "token_len_1k"            : lambda: token_len(TEXT_1K),
+    "subprompt_create_1k"     : lambda: SubPrompt(TEXT_1K).tokens,
+    "subprompt_add"           : lambda: SP_A + SP_B,
+    "subprompt_truncate_65k"  : truncate_65k,
+    "context_add_evict"       : context_add_evict,
+    "message_task_completion" : lambda: massgpt.msg_response_task.completion(CONTEXT.sub_prompts(), USER_MSG),
+    "current_context"         : lambda: list(massgpt.current_context(CONTEXT)),
+    "extract_text_from_html"  : lambda: extract_text_from_html(HTML_SUMMARY),
+}
+
+
+def measure(fn, rounds : int, min_time : float = 0.2) -> float:
+    """
+    return the median seconds per call of fn over rounds rounds of at least min_time each
+    """
+    number = 1
+    while True:
+        t0 = perf_counter()
+        for i in range(number):
+            fn()
+        dt = perf_counter() - t0
+        if dt >= min_time / 4:
+            break
+        number *= 2
+    times = []
+    for r in range(rounds):
+        t0 = perf_counter()
+        for i in range(number):
+            fn()
+        times.append((perf_counter() - t0) / number)
+    return statistics.median(times)
+
+
+def machine() -> dict:
+    """
+    describe the machine and python the timings are measured with
+    """
+    cpu = platform.processor()
+    try:
+        with open("/proc/cpuinfo") as f:
+            cpu = next(line.split(":", 1)[1].strip() for line in f if line.startswith("model name"))
+    except (OSError, StopIteration):
+        pass
+    return {"platform" : platform.platform(),
+            "cpu"      : cpu,
+            "cpus"     : os.cpu_count(),
+            "python"   : platform.python_version()}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--save",      action="store_true")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed fractional slowdown vs baseline")
+    parser.add_argument("--rounds",    type=int,   default=5)
+    parser.add_argument("cases",       nargs="*",  default=list(CASES))
+    args = parser.parse_args()
+
+    logger.remove()   # the prompt assembly logging would dominate the timings
+    current = machine()
+    saved = {"machine": current, "cases": {}}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as f:
+            saved = json.load(f)
+    baseline = saved["cases"]
+    same_machine = saved["machine"] == current
+    if baseline and not same_machine:
+        print(f"baseline was saved on {saved['machine']}")
+        print(f"this machine is       {current}")
+        print("regressions are reported but not failed")
+
+    results = {}
+    regressions = []
+    for name in args.cases:
+        results[name] = measure(CASES[name], args.rounds)
+        line = f"{name:26} {results[name]*1e6:12.1f} us"
+        if name in baseline:
+            ratio = results[name] / baseline[name]
+            line += f"   {ratio:5.2f}x baseline"
+            if ratio > 1 + args.threshold:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line)
+
+    if args.save:
+        # timings from another machine aren't comparable with these
+        cases = {**baseline, **results} if same_machine else results
+        with open(BASELINE_PATH, "w") as f:
+            json.dump({"machine": current, "cases": cases}, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"saved baseline to {BASELINE_PATH}")
+    elif regressions:
+        print(f"{len(regressions)} regressions: {', '.join(regressions)}")
+        if same_machine:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,7 +13,11 @@ Copyright (C) 2022 William S. Kish
 """
 
 import os
-from sqlmodel import Session, select
+import asyncio
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor
+from sqlmodel import select
+from sqlalchemy.exc import IntegrityError
 from loguru import logger
 from pydantic import BaseModel, Field
 from telegram import Update
@@ -21,15 +25,108 @@ from telegram.ext import ApplicationBuilder, MessageHandler, CommandHandler, Con
 import re
 
 import openai
-from db import engine
+from db import async_session
+from lru import LRUCache
 from models import *
 from exceptions import *
 
 import massgpt
+import gpt3
+import webhook
+from bus import PostgresBus
+from db import PG_DSN
+from scheduler import scheduler
+import metrics
+import startup
+from tokenizer import tokenizer
+from sendqueue import SendRateLimiter, coalesce
 
 
+# how the bot receives updates:
+#   "polling" - a single process polls telegram
+#   "webhook" - webhook.WEBHOOK_WORKERS processes take updates posted to the local webhook endpoint
+BOT_MODE = os.environ.get("MASSGPT_BOT_MODE", "polling")
+# how context updates reach the other processes: "local" (single process) or "postgres" (LISTEN/NOTIFY)
+CONTEXT_BUS = os.environ.get("MASSGPT_CONTEXT_BUS", "postgres" if BOT_MODE == "webhook" else "local")
+
+# number of updates handled concurrently
+BOT_CONCURRENT_UPDATES = int(os.environ.get("MASSGPT_CONCURRENT_UPDATES", 16))
+# worker threads for the blocking extraction and completion work of the handlers
+BOT_WORKER_THREADS = int(os.environ.get("MASSGPT_WORKER_THREADS", 2*BOT_CONCURRENT_UPDATES))
+
+
+def st_model_init_done(future : asyncio.Future) -> None:
+    """
+    log the failure of the background embedding model load, since nothing awaits it
+    """
+    if not future.cancelled() and future.exception() is not None:
+        metrics.HANDLED_EXCEPTIONS.labels("startup", future.exception().__class__.__name__).inc()
+        logger.opt(exception=future.exception()).error("startup: embedding model failed to load; it will be retried on first use")
+
+
+async def post_init(application) -> None:
+    """
+    startup sequence, run before polling starts.
+    The tokenizer loads in a worker thread while the context rows are read from the
+    database.  The rows are converted to sub prompts in worker threads, which wait
+    for the tokenizer there rather than on the event loop.  The embedding model is
+    only needed by the persist writer so it loads in the background without holding
+    up readiness.
+    """
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(BOT_WORKER_THREADS))
+    t0 = monotonic()
+    if CONTEXT_BUS == "postgres":
+        # listen before loading so no update is missed
+        bus = PostgresBus(PG_DSN)
+        massgpt.contexts.attach(bus)
+        await bus.start()
+    # the tokenizer is needed first, so it takes a worker thread before the embedding model
+    tokenizer_init = loop.run_in_executor(None, tokenizer.init)
+    st_model_init = loop.run_in_executor(None, massgpt.st_model.init)
+    st_model_init.add_done_callback(st_model_init_done)
+    gpt3.check_config()
+    await massgpt.load_context_from_db()
+    await tokenizer_init
+    startup.record("total", monotonic() - t0)
+    startup.set_ready()
+
+
+# throttles the bot's requests to telegram's flood limits
+rate_limiter = SendRateLimiter()
+
 # the bot app
-bot = ApplicationBuilder().token(os.environ['MASSGPT_TELEGRAM_API_TOKEN']).build()
+bot = ApplicationBuilder().token(os.environ['MASSGPT_TELEGRAM_API_TOKEN']) \
+                          .concurrent_updates(BOT_CONCURRENT_UPDATES) \
+                          .rate_limiter(rate_limiter) \
+                          .post_init(post_init) \
+                          .build()
+
+# stream message responses into the reply as the completion arrives
+STREAM_REPLIES = os.environ.get("MASSGPT_STREAM_REPLIES", "1") == "1"
+# minimum seconds between edits of a streaming reply
+STREAM_EDIT_INTERVAL = float(os.environ.get("MASSGPT_STREAM_EDIT_INTERVAL", 1.0))
+STREAM_PLACEHOLDER = "…"
+# sent in place of a completion that is empty or only whitespace, which telegram rejects
+EMPTY_REPLY = "(no response)"
+
+
+# how messages are routed to contexts:
+#   "chat"   - each group chat (and forum topic) has its own context; private chats share the default context
+#   "global" - all messages share the default context
+CONTEXT_ROUTING = os.environ.get("MASSGPT_CONTEXT_ROUTING", "chat")
+
+
+def context_name(update : Update) -> str:
+    """
+    return the name of the context the message should be routed to
+    """
+    chat = update.effective_chat
+    if CONTEXT_ROUTING == "global" or chat.type == "private":
+        return massgpt.DEFAULT_CONTEXT
+    if update.message.is_topic_message:
+        return f"chat-{chat.id}-topic-{update.message.message_thread_id}"
+    return f"chat-{chat.id}"
 
 
 def extract_url(text: str):
@@ -40,28 +137,114 @@ def extract_url(text: str):
 
 
 
-def get_telegram_user(update : Update) -> User:
+# telegram_id -> User of recent senders
+TELEGRAM_USER_CACHE_SIZE = int(os.environ.get("MASSGPT_TELEGRAM_USER_CACHE_SIZE", 10000))
+telegram_users = LRUCache(TELEGRAM_USER_CACHE_SIZE)
+
+# telegram_id -> Task loading or creating the User, so concurrent first messages share one lookup
+_user_lookups = {}
+
+
+async def _load_telegram_user(tuser) -> User:
     """
-    return database User object of the sender of a telegram message
-    Create the user if it didn't previously exist.
+    return the database User for the telegram user, creating it if it didn't previously exist
     """
-    with Session(engine) as session:
-        user = session.exec(select(User).where(User.telegram_id == update.message.from_user.id)).first()
+    async with async_session() as session:
+        user = (await session.exec(select(User).where(User.telegram_id == tuser.id))).first()
         if not user:
-            tuser = update.message.from_user
-            user =  User(username              = tuser.username,
-                         first_name            = tuser.first_name,
-                         last_name             = tuser.last_name,
-                         telegram_id           = tuser.id,
-                         telegram_is_bot       = tuser.is_bot,
-                         telegram_is_premium   = tuser.is_premium,
-                         telegram_lanuage_code = tuser.language_code)
+            user =  User(username               = tuser.username,
+                         first_name             = tuser.first_name,
+                         last_name              = tuser.last_name,
+                         telegram_id            = tuser.id,
+                         telegram_is_bot        = tuser.is_bot,
+                         telegram_is_premium    = tuser.is_premium,
+                         telegram_language_code = tuser.language_code)
             session.add(user)
-            session.commit()
-            session.refresh(user)
+            try:
+                await session.commit()
+                await session.refresh(user)
+            except IntegrityError:
+                # another worker process created it first
+                await session.rollback()
+                user = (await session.exec(select(User).where(User.telegram_id == tuser.id))).one()
+    telegram_users.put(tuser.id, user)
     return user
 
 
+async def get_telegram_user(update : Update) -> User:
+    """
+    return database User object of the sender of a telegram message
+    Create the user if it didn't previously exist.  Concurrent lookups in this process
+    share one query; the unique telegram_id keeps other processes from adding a duplicate.
+    Recent senders are served from the telegram_users cache.
+    """
+    tuser = update.message.from_user
+    user = telegram_users.get(tuser.id)
+    if user is not None:
+        return user
+    lookup = _user_lookups.get(tuser.id)
+    if lookup is None:
+        lookup = asyncio.ensure_future(_load_telegram_user(tuser))
+        _user_lookups[tuser.id] = lookup
+        lookup.add_done_callback(lambda task: _user_lookups.pop(tuser.id, None))
+    # shield so a cancelled handler doesn't cancel the lookup for the others
+    return await asyncio.shield(lookup)
+
+
+
+async def stream_reply(update : Update, deltas) -> None:
+    """
+    Reply to the message with the text generated by the deltas iterator.
+    The iterator is run in a worker thread.  A placeholder reply is sent immediately
+    and then edited at most every STREAM_EDIT_INTERVAL seconds as text arrives.
+    Intermediate edits are skipped while the chat's rate limit has no room, so they
+    never queue; only the final edit waits for it.
+    Exceptions raised by the iterator are re-raised here after removing the placeholder.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    done = object()
+
+    def produce():
+        try:
+            for delta in deltas:
+                loop.call_soon_threadsafe(queue.put_nowait, delta)
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+
+    reply = await update.message.reply_text(STREAM_PLACEHOLDER)
+    producer = loop.run_in_executor(None, produce)
+    text = ""
+    sent = STREAM_PLACEHOLDER
+    last_edit = monotonic()
+    while True:
+        items = [await queue.get()]
+        while not queue.empty():
+            items.append(queue.get_nowait())
+        for item in items:
+            if isinstance(item, Exception):
+                await producer
+                await reply.delete()
+                raise item
+        finished = items[-1] is done
+        text += "".join(item for item in items if item is not done)
+        if finished:
+            break
+        # telegram rejects empty messages and edits that don't change the text;
+        # it strips leading and trailing whitespace, so whitespace alone isn't a change
+        if (text.strip() and text.strip() != sent.strip() and monotonic() - last_edit >= STREAM_EDIT_INTERVAL
+                and rate_limiter.ready(update.effective_chat.id)):
+            await reply.edit_text(text)
+            sent = text
+            last_edit = monotonic()
+    await producer
+    if not text.strip():
+        text = EMPTY_REPLY
+    if text.strip() != sent.strip():
+        await reply.edit_text(text)
+
+
 
 async def message(update: Update, tgram_context: ContextTypes.DEFAULT_TYPE) -> None:
     """
@@ -69,26 +252,35 @@ async def message(update: Update, tgram_context: ContextTypes.DEFAULT_TYPE) -> N
     Send back to the user the response text from the model.
     Handle exceptions by sending an error message to the user.    
     """
-    user = get_telegram_user(update)
+    user = await get_telegram_user(update)
     text = update.message.text    
     logger.info(f'{user.id} {user.first_name} {user.last_name} {user.username} {user.telegram_id}: "{text}"')
     try:
+        context = await massgpt.contexts.get(context_name(update))
         url = extract_url(text)
         print("URL", url)
         if url:
-            response = massgpt.summarize_url(user, url)
+            response = await asyncio.to_thread(massgpt.summarize_url, user, url, context)
+        elif STREAM_REPLIES:
+            await stream_reply(update, massgpt.receive_message_stream(user, text, context))
+            return
         else:
-            response = massgpt.receive_message(user, text)
+            response = await asyncio.to_thread(massgpt.receive_message, user, text, context)
         await update.message.reply_text(response)
-    except (openai.error.ServiceUnavailableError, openai.error.RateLimitError): 
+    except (openai.error.ServiceUnavailableError, openai.error.RateLimitError) as e: 
+        metrics.HANDLED_EXCEPTIONS.labels("message", e.__class__.__name__).inc()
         await update.message.reply_text("The OpenAI server is overloaded.")
-    except ExtractException:
+    except ExtractException as e:
+        metrics.HANDLED_EXCEPTIONS.labels("message", e.__class__.__name__).inc()
         await update.message.reply_text("Unable to extract text from url.")
-    except MinimumTokenLimit:
+    except MinimumTokenLimit as e:
+        metrics.HANDLED_EXCEPTIONS.labels("message", e.__class__.__name__).inc()
         await update.message.reply_text("Message too short; please send a longer message.")
-    except MaximumTokenLimit:
+    except MaximumTokenLimit as e:
+        metrics.HANDLED_EXCEPTIONS.labels("message", e.__class__.__name__).inc()
         await update.message.reply_text("Message too large; please send a shorter message.")
     except Exception as e:
+        metrics.HANDLED_EXCEPTIONS.labels("message", e.__class__.__name__).inc()
         logger.exception("error processing message")
         await update.message.reply_text("An exceptional condition occured.")
         
@@ -110,15 +302,15 @@ async def command(update: Update, tgram_context: ContextTypes.DEFAULT_TYPE) -> N
     context - Respond with the current chat context
     url - Summarize a url and add the summary to the chat context
     """
-    user = get_telegram_user(update)
+    user = await get_telegram_user(update)
     text = update.message.text
     
     logger.info(f'{user.id} {user.first_name} {user.last_name} {user.username} {user.telegram_id}: "{text}"')
     
 
     if text == '/context':
-        await update.message.reply_text("The current context:")            
-        for msg in massgpt.current_context():
+        context = await massgpt.contexts.get(context_name(update))
+        for msg in coalesce(["The current context:", *massgpt.current_context(context)]):
             await update.message.reply_text(msg)
         return
     elif text == '/prompts':
@@ -127,13 +319,17 @@ async def command(update: Update, tgram_context: ContextTypes.DEFAULT_TYPE) -> N
     elif text[:5] == '/url ':
         try:
             url = extract_url(text)            
-            response = massgpt.summarize_url(user, url)
+            context = await massgpt.contexts.get(context_name(update))
+            response = await asyncio.to_thread(massgpt.summarize_url, user, url, context)
             await update.message.reply_text(response)
-        except (openai.error.ServiceUnavailableError, openai.error.RateLimitError):
+        except (openai.error.ServiceUnavailableError, openai.error.RateLimitError) as e:
+            metrics.HANDLED_EXCEPTIONS.labels("url", e.__class__.__name__).inc()
             await update.message.reply_text("The OpenAI server is overloaded.")
-        except ExtractException:
+        except ExtractException as e:
+            metrics.HANDLED_EXCEPTIONS.labels("url", e.__class__.__name__).inc()
             await update.message.reply_text("Unable to extract text from url.")
         except Exception as e:
+            metrics.HANDLED_EXCEPTIONS.labels("url", e.__class__.__name__).inc()
             logger.exception("error processing message")
             await update.message.reply_text("An exceptional condition occured.")
         return    
@@ -143,5 +339,30 @@ async def command(update: Update, tgram_context: ContextTypes.DEFAULT_TYPE) -> N
 bot.add_handler(MessageHandler(filters.COMMAND, command))
 
 
-logger.info("run_polling")
-bot.run_polling()
+def worker_init(worker_id : int) -> None:
+    """
+    per-process setup of a webhook worker
+    """
+    massgpt.persist_writer.spool_path += f".{worker_id}"
+    scheduler.partition(webhook.WEBHOOK_WORKERS)
+    rate_limiter.partition(webhook.WEBHOOK_WORKERS)
+    if CONTEXT_BUS == "postgres":
+        # the workers share the contexts, so each context is compacted by one of them
+        massgpt.compactor.partition(worker_id, webhook.WEBHOOK_WORKERS)
+    metrics.start_metrics_server(port_offset=worker_id)
+    startup.start_health_server(port_offset=worker_id)
+
+
+def main() -> None:
+    if BOT_MODE == "webhook":
+        webhook.run(bot, worker_init)
+    else:
+        metrics.start_metrics_server()
+        startup.start_health_server()
+        logger.info("run_polling")
+        bot.run_polling()
+
+
+# spawned worker processes (e.g. the pdf extraction pool) import this module without running it
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#  Message bus for sharing context updates between worker processes
+#  Copyright (C) 2022 William S. Kish
+#
+#  PostgresBus uses LISTEN/NOTIFY on the app database so no extra infrastructure
+#  is needed.  LocalBus delivers in-process, for a single process and for tests.
+
+import asyncio
+from collections import defaultdict
+from loguru import logger
+import asyncpg
+
+
+class LocalBus:
+    """
+    Deliver published payloads to the subscribers in this process
+    """
+    def __init__(self) -> "LocalBus":
+        self._subscribers = defaultdict(list)
+
+    def subscribe(self, channel : str, callback) -> None:
+        """
+        call callback(payload) for each payload published on channel
+        """
+        self._subscribers[channel].append(callback)
+
+    def publish(self, channel : str, payload : str) -> None:
+        for callback in self._subscribers[channel]:
+            callback(payload)
+
+    async def start(self) -> None:
+        pass
+
+
+
+class PostgresBus:
+    """
+    Deliver published payloads to the subscribers in every process connected to
+    the database via NOTIFY.  publish() may be called from any thread; the
+    notifications are sent from the event loop the bus was started on.
+    Payloads are limited to 8000 bytes by postgres.
+    """
+    MAX_PAYLOAD = 7999
+    RECONNECT_DELAY = 1   # seconds
+
+    def __init__(self, dsn : str) -> "PostgresBus":
+        self.dsn = dsn
+        self._subscribers = defaultdict(list)
+        self._loop = None
+        self._outbox = None
+
+    def subscribe(self, channel : str, callback) -> None:
+        """
+        call callback(payload) on the event loop for each payload published on channel
+        """
+        self._subscribers[channel].append(callback)
+
+    def publish(self, channel : str, payload : str) -> None:
+        if len(payload.encode()) > PostgresBus.MAX_PAYLOAD:
+            logger.warning(f"bus: dropping {len(payload)} byte payload on {channel}")
+            return
+        self._loop.call_soon_threadsafe(self._outbox.put_nowait, (channel, payload))
+
+    async def start(self) -> None:
+        """
+        start listening and sending; returns once the subscriptions are listening
+        """
+        self._loop = asyncio.get_running_loop()
+        self._outbox = asyncio.Queue()
+        listening = asyncio.Event()
+        asyncio.create_task(self._listen(listening))
+        asyncio.create_task(self._send())
+        await listening.wait()
+
+    def _deliver(self, connection, pid, channel, payload) -> None:
+        for callback in self._subscribers[channel]:
+            try:
+                callback(payload)
+            except Exception:
+                logger.exception(f"bus: {channel} subscriber")
+
+    async def _listen(self, listening : asyncio.Event) -> None:
+        while True:
+            try:
+                connection = await asyncpg.connect(self.dsn)
+                closed = asyncio.Event()
+                connection.add_termination_listener(lambda connection: closed.set())
+                for channel in self._subscribers:
+                    await connection.add_listener(channel, self._deliver)
+                logger.info(f"bus: listening on {', '.join(self._subscribers)}")
+                listening.set()
+                await closed.wait()
+                logger.warning("bus: listener connection closed")
+            except Exception:
+                logger.exception("bus: listen")
+            await asyncio.sleep(PostgresBus.RECONNECT_DELAY)
+
+    async def _send(self) -> None:
+        connection = None
+        while True:
+            channel, payload = await self._outbox.get()
+            try:
+                if connection is None or connection.is_closed():
+                    connection = await asyncpg.connect(self.dsn)
+                await connection.execute("SELECT pg_notify($1, $2)", channel, payload)
+            except Exception:
+                logger.exception(f"bus: dropping payload on {channel}")
+                connection = None
@@ -0,0 +1,76 @@
+#  Local persistent key/value cache
+#  Copyright (C) 2022 William S. Kish
+
+import json
+import sqlite3
+import threading
+from time import time
+from loguru import logger
+
+
+class LocalCache:
+    """
+    A small persistent key/value cache backed by a local sqlite file.
+    Values are json-serializable objects.
+    When the total size of the stored values exceeds max_bytes the least recently
+    used entries are evicted.
+    """
+    # evict down to this fraction of max_bytes so we don't evict on every put
+    EVICT_TO = 0.9
+
+    def __init__(self, path : str, max_bytes : int) -> "LocalCache":
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS cache (key      TEXT PRIMARY KEY,"
+                         "                                  value    TEXT NOT NULL,"
+                         "                                  size     INTEGER NOT NULL,"
+                         "                                  accessed REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+        self._bytes = self._total_bytes()
+
+    def _total_bytes(self) -> int:
+        return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+
+    def get(self, key : str):
+        """
+        return the value stored for key or None if not present
+        """
+        with self._lock:
+            row = self._db.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE cache SET accessed = ? WHERE key = ?", (time(), key))
+        return json.loads(row[0])
+
+    def put(self, key : str, value) -> None:
+        """
+        store value for key, evicting least recently used entries if over max_bytes
+        """
+        text = json.dumps(value)
+        size = len(key) + len(text.encode())
+        if size > self.max_bytes:
+            logger.warning(f"LocalCache: {size} byte value exceeds cache size")
+            return
+        with self._lock:
+            row = self._db.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+            self._db.execute("INSERT OR REPLACE INTO cache (key, value, size, accessed) VALUES (?, ?, ?, ?)",
+                             (key, text, size, time()))
+            self._bytes += size - (row[0] if row else 0)
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        # other processes may share the cache file so recount before evicting
+        self._bytes = self._total_bytes()
+        target = self.max_bytes * LocalCache.EVICT_TO
+        evicted = 0
+        for key, size in self._db.execute("SELECT key, size FROM cache ORDER BY accessed").fetchall():
+            if self._bytes <= target:
+                break
+            self._db.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self._bytes -= size
+            evicted += 1
+        logger.info(f"LocalCache {self.path}: evicted {evicted} entries")
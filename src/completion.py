@@ -3,15 +3,43 @@
 
 
 import os
+import json
+import queue
+import threading
+from time import monotonic
+from concurrent.futures import Future, ThreadPoolExecutor
+from hashlib import sha256
+from loguru import logger
 from pydantic import BaseModel, Field
 from sqlmodel import Session, select
 
 from models import Completion
 from subprompt import SubPrompt
+from cache import LocalCache
+from scheduler import scheduler, Priority
+import metrics
 
 from exceptions import *
 
 
+# Completion Cache Config
+COMPLETION_CACHE_PATH      = os.environ.get("MASSGPT_COMPLETION_CACHE_PATH", "completion_cache.sqlite")
+COMPLETION_CACHE_MAX_BYTES = int(os.environ.get("MASSGPT_COMPLETION_CACHE_MAX_BYTES", 256*1024*1024))
+
+_completion_cache = None
+_completion_cache_lock = threading.Lock()
+
+def completion_cache() -> LocalCache:
+    """
+    return the process-wide completion cache, opening it on first use
+    """
+    global _completion_cache
+    with _completion_cache_lock:
+        if _completion_cache is None:
+            _completion_cache = LocalCache(COMPLETION_CACHE_PATH, COMPLETION_CACHE_MAX_BYTES)
+    return _completion_cache
+
+
 class CompletionLimits(BaseModel):
     """
     specification for limits for:
@@ -33,8 +61,10 @@ class CompletionLimits(BaseModel):
         is too small or too big.
         """
         if prompt.tokens < self.min_prompt:
+            metrics.TOKEN_LIMIT_REJECTIONS.labels("minimum").inc()
             raise MinimumTokenLimit
         if prompt.tokens > self.max_prompt_tokens():
+            metrics.TOKEN_LIMIT_REJECTIONS.labels("maximum").inc()
             raise MaximumTokenLimit
         max_available_tokens = self.max_context - prompt.tokens
         if max_available_tokens > self.max_completion:
@@ -55,7 +85,19 @@ class CompletionTask:
     This is a base class for a model-specific completion task.  A model-api-specific implemention must
     at a minimum implement the _completion() method.
     See gpt3.GPT3CompletionTask for an example implementation.
+
+    Tasks whose completions are repeatable (e.g. temperature 0 experiments) can set
+    CACHEABLE = True to serve identical requests from the local completion cache.
+
+    All api requests are made through the global scheduler in the task's PRIORITY lane.
+
+    Implementations whose api accepts multiple prompts per request can implement
+    _completion_batch() and set MAX_BATCH to the maximum prompts per request.
     """
+    CACHEABLE = False
+    PRIORITY  = Priority.background
+    MAX_BATCH = 1
+    
     def __init__(self,
                  limits      : CompletionLimits,                 
                  model       : str) -> "CompletionTask" :
@@ -69,6 +111,23 @@ class CompletionTask:
     def limits(self) -> CompletionLimits:
         return self.limits
 
+    def params(self) -> dict:
+        """
+        return the model sampling parameters that influence the completion output.
+        This should be implemented in a model-api-specific base class.
+        """
+        return {}
+
+    def _cache_key(self, prompt : str, max_completion_tokens : int) -> str:
+        """
+        return the completion cache key for the prompt given the model and sampling params
+        """
+        key = {"model"      : self.model,
+               "prompt"     : sha256(prompt.encode()).hexdigest(),
+               "max_tokens" : max_completion_tokens,
+               **self.params()}
+        return sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+    
     def _completion(self,
                     prompt                : str,                        
                     max_completion_tokens : int) -> str :
@@ -78,6 +137,32 @@ class CompletionTask:
         """
         pass
 
+    def _completion_batch(self,
+                          prompts               : list[str],
+                          max_completion_tokens : int) -> list[str] :
+        """
+        perform the completions for multiple prompts in one api request, returning
+        the completion text strings in prompt order.
+        Model-api-specific base classes may implement this if MAX_BATCH > 1.
+        """
+        return [self._completion(prompt, max_completion_tokens) for prompt in prompts]
+
+    def _completion_stream(self,
+                           prompt                : str,
+                           max_completion_tokens : int):
+        """
+        generate the completion text in deltas as the model produces it.
+        Model-api-specific base classes may implement this to stream;
+        by default the whole completion is generated as a single delta.
+        """
+        yield self._completion(prompt, max_completion_tokens)
+
+    def _record(self, prompt : SubPrompt, response : str) -> Completion:
+        return Completion(model       = self.model,
+                          prompt      = str(prompt),
+                          temperature = 0, # XXX  set this as model params?
+                          completion  = response)
+
     def completion(self, prompt : SubPrompt) -> Completion:
         """
         prompt the model with the specified prompt and return the resulting Completion
@@ -86,12 +171,170 @@ class CompletionTask:
         # given the size of the prompt and the configured limits
         max_completion = self.limits.max_completion_tokens(prompt)
         
-        # perform the completion inference
-        response = self._completion(prompt                = str(prompt),
-                                    max_completion_tokens = max_completion)
-
-        completion = Completion(model       = self.model,
-                                prompt      = str(prompt),
-                                temperature = 0, # XXX  set this as model params?
-                                completion  = response)
-        return completion
+        # perform the completion inference, consulting the cache if this task is cacheable
+        response = None
+        if self.CACHEABLE:
+            key = self._cache_key(str(prompt), max_completion)
+            response = completion_cache().get(key)
+            if response is not None:
+                logger.info("completion cache hit")
+        if response is None:
+            # reserve the worst case token usage against the api quotas
+            scheduler.acquire(tokens   = prompt.tokens + max_completion,
+                              priority = self.PRIORITY)
+            response = self._completion(prompt                = str(prompt),
+                                        max_completion_tokens = max_completion)
+            if self.CACHEABLE:
+                completion_cache().put(key, response)
+
+        return self._record(prompt, response)
+
+    def completion_stream(self, prompt : SubPrompt) -> "CompletionStream":
+        """
+        prompt the model with the specified prompt and return a CompletionStream
+        that generates the completion text deltas as they arrive.
+        Prompt limits are checked immediately.
+        """
+        return CompletionStream(task           = self,
+                                prompt         = prompt,
+                                max_completion = self.limits.max_completion_tokens(prompt))
+
+    def completion_batch(self, prompts : list[SubPrompt]) -> list[Completion]:
+        """
+        prompt the model with each of the prompts and return the resulting Completions in order.
+        The prompts are sent MAX_BATCH at a time in a single api request.
+        """
+        # max_tokens applies to every prompt in a request so use the smallest limit
+        max_completion = min(self.limits.max_completion_tokens(prompt) for prompt in prompts)
+
+        responses = [None] * len(prompts)
+        if self.CACHEABLE:
+            keys = [self._cache_key(str(prompt), max_completion) for prompt in prompts]
+            responses = [completion_cache().get(key) for key in keys]
+        misses = [i for i, response in enumerate(responses) if response is None]
+        logger.info(f"completion_batch: {len(prompts)-len(misses)} of {len(prompts)} cached")
+
+        for b in range(0, len(misses), self.MAX_BATCH):
+            batch = misses[b:b+self.MAX_BATCH]
+            scheduler.acquire(tokens   = sum(prompts[i].tokens + max_completion for i in batch),
+                              priority = self.PRIORITY)
+            texts = self._completion_batch(prompts               = [str(prompts[i]) for i in batch],
+                                           max_completion_tokens = max_completion)
+            for i, response in zip(batch, texts):
+                responses[i] = response
+                if self.CACHEABLE:
+                    completion_cache().put(keys[i], response)
+
+        return [self._record(prompt, response) for prompt, response in zip(prompts, responses)]
+
+
+
+class CompletionStream:
+    """
+    Iterate over a CompletionStream to receive the completion text deltas as they arrive.
+    Once the iteration is complete the resulting Completion is available as .completion
+    """
+    def __init__(self,
+                 task           : CompletionTask,
+                 prompt         : SubPrompt,
+                 max_completion : int) -> "CompletionStream":
+        self.task = task
+        self.prompt = prompt
+        self.max_completion = max_completion
+        self.completion = None
+
+    def __iter__(self):
+        task = self.task
+        if task.CACHEABLE:
+            key = task._cache_key(str(self.prompt), self.max_completion)
+            response = completion_cache().get(key)
+            if response is not None:
+                logger.info("completion cache hit")
+                yield response
+                self.completion = task._record(self.prompt, response)
+                return
+
+        scheduler.acquire(tokens   = self.prompt.tokens + self.max_completion,
+                          priority = task.PRIORITY)
+        deltas = []
+        for delta in task._completion_stream(prompt                = str(self.prompt),
+                                             max_completion_tokens = self.max_completion):
+            deltas.append(delta)
+            yield delta
+        response = "".join(deltas)
+        if task.CACHEABLE:
+            completion_cache().put(key, response)
+        self.completion = task._record(self.prompt, response)
+
+
+
+class CompletionBatcher:
+    """
+    Collect prompts submitted from multiple threads for a non-interactive CompletionTask
+    and send them together through task.completion_batch().
+    A batch is sent once max_batch (at most task.MAX_BATCH) prompts are queued or max_wait
+    seconds after the first prompt of the batch was queued, with at most parallel batches
+    in flight.  While all are in flight the next batch keeps filling.
+    The batching thread is started on first use in each process.
+    """
+    def __init__(self,
+                 task      : CompletionTask,
+                 max_wait  : float = 0.1,
+                 max_batch : int = None,
+                 parallel  : int = 1) -> "CompletionBatcher":
+        self.task = task
+        self.max_wait = max_wait
+        self.max_batch = min(task.MAX_BATCH, max_batch or task.MAX_BATCH)
+        self.parallel = parallel
+        self._lock = threading.Lock()
+        self._pid = None           # process the batching thread was started in
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            self._slots = threading.Semaphore(self.parallel)
+            self._pool = ThreadPoolExecutor(self.parallel)
+            threading.Thread(target=self._run, daemon=True).start()
+            self._pid = os.getpid()
+
+    def submit(self, prompt : SubPrompt) -> Future:
+        """
+        queue the prompt for completion, returning a Future for its Completion
+        """
+        # check limits now so one bad prompt doesn't fail the whole batch
+        self.task.limits.max_completion_tokens(prompt)
+        if self._pid != os.getpid():
+            self._start()
+        future = Future()
+        self._queue.put((prompt, future))
+        return future
+
+    def completion(self, prompt : SubPrompt) -> Completion:
+        return self.submit(prompt).result()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = monotonic() + self.max_wait
+            # wait for a free slot while the batch fills
+            self._slots.acquire()
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get(timeout=max(0, deadline - monotonic())))
+                except queue.Empty:
+                    break
+            self._pool.submit(self._complete, batch)
+
+    def _complete(self, batch : list[tuple[SubPrompt, Future]]) -> None:
+        try:
+            completions = self.task.completion_batch([prompt for prompt, future in batch])
+        except Exception as e:
+            for prompt, future in batch:
+                future.set_exception(e)
+            return
+        finally:
+            self._slots.release()
+        for (prompt, future), completion in zip(batch, completions):
+            future.set_result(completion)
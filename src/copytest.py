@@ -36,6 +36,7 @@ class GPTCopyTestTask(GPT3CompletionTask):
     Generated message response completions based on dynamic history of recent messages and most used message
     """
     TEMPERATURE = 0.0
+    CACHEABLE = True
     
     # General Prompt Strategy:
     #  Upon reception of message from a user 999, compose the following prompt
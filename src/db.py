@@ -1,6 +1,9 @@
 # database engine
 import os
 from sqlmodel import create_engine, SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.orm import sessionmaker
 
 
 
@@ -9,10 +12,26 @@ db_host = os.environ['MASSGPT_POSTGRES_HOST']
 user = os.environ['MASSGPT_POSTGRES_USER']
 passwd = os.environ['MASSGPT_POSTGRES_PASS']
 
+# connection pool sizing; the async pool should cover the bot's concurrent updates
+DB_POOL_SIZE    = int(os.environ.get("MASSGPT_DB_POOL_SIZE", 16))
+DB_MAX_OVERFLOW = int(os.environ.get("MASSGPT_DB_MAX_OVERFLOW", 8))
+
 DBURI = 'postgresql+psycopg2://%s:%s@%s:5432/massgpt' % (user, passwd, db_host)
+ASYNC_DBURI = 'postgresql+asyncpg://%s:%s@%s:5432/massgpt' % (user, passwd, db_host)
+PG_DSN = 'postgresql://%s:%s@%s:5432/massgpt' % (user, passwd, db_host)   # for direct asyncpg connections
 
 engine = create_engine(DBURI, pool_pre_ping=True, echo=False)
 
+# async engine for use from the bot's event loop
+async_engine = create_async_engine(ASYNC_DBURI,
+                                   pool_pre_ping = True,
+                                   pool_size     = DB_POOL_SIZE,
+                                   max_overflow  = DB_MAX_OVERFLOW,
+                                   echo          = False)
+
+# objects stay usable after commit since they are typically returned to the caller
+async_session = sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+
 if __name__ == "__main__":
     from models import *
     SQLModel.metadata.create_all(engine)
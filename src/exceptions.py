@@ -39,3 +39,20 @@ class NetworkError(ExtractException):
     """
 
     
+class ContentTooLarge(ExtractException):
+    """
+    The content exceeds the maximum size we are willing to download.
+    """
+
+
+
+class ArtifactIntegrityError(Exception):
+    """
+    A downloaded artifact doesn't match its manifest.
+    """
+
+
+class IndexSnapshotNotFound(Exception):
+    """
+    No index snapshot of the collection has been stored.
+    """
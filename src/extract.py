@@ -2,66 +2,137 @@
 Extract readable text from a URL via various hacks
 """
 
+import os
 from loguru import logger
 from bs4 import BeautifulSoup, NavigableString, Tag
+from lxml import etree
+import lxml.html
 from readability import Document    # https://github.com/buriy/python-readability
-import requests
 import urllib.parse
 
-from github_api import github_readme_text
-from pdf_text import pdf_text
+from github_api import github_readme_chunks
+from pdf_text import pdf_text_chunks
+from fetch import fetch
+from tokenizer import CHARS_PER_TOKEN
+import metrics
 
 from exceptions import *
-    
 
-def extract_text_from_html(content):
+
+# html text extraction backend:
+#   "lxml" - fast path using the lxml tree directly
+#   "bs4"  - original BeautifulSoup html.parser path
+HTML_EXTRACT_BACKEND = os.environ.get("MASSGPT_HTML_EXTRACT_BACKEND", "lxml")
+
+# text in these elements is not readable content
+# there may be more elements we don't want
+BLACKLIST = ['[document]','noscript','header','html','meta','head','input','script', "style"]
+
+# when extracting for a token budget, keep extracting until this multiple of the
+# budget (by estimated token count) has been reached
+EXTRACT_TOKEN_MARGIN = float(os.environ.get("MASSGPT_EXTRACT_TOKEN_MARGIN", 1.25))
+
+
+def extract_text_from_html_bs4(content):
     soup = BeautifulSoup(content, 'html.parser')
 
     output =  ""
     title = soup.find('title')
     if title:
-        output += "Title: " + title
+        output += "Title: " + title.get_text()
         
-    blacklist = ['[document]','noscript','header','html','meta','head','input','script', "style"]
-    # there may be more elements we don't want
-    
     for t in soup.find_all(text=True):
-        if t.parent.name not in blacklist:
+        if t.parent.name not in BLACKLIST:
             output += '{} '.format(t)
     return output
 
 
-def get_url_text(url):
+def iter_text_from_html_bs4(content):
     """
-    get url content and extract readable text
-    returns the text
+    generate the readable text strings of the html in document order using bs4
     """
-    resp = requests.get(url, timeout=30)
+    soup = BeautifulSoup(content, 'html.parser')
+    title = soup.find('title')
+    if title:
+        yield "Title: " + title.get_text()
+    for t in soup.find_all(text=True):
+        if t.parent.name not in BLACKLIST:
+            yield '{} '.format(t)
 
-    if resp.status_code != 200:
-        logger.warning(url)
-        raise NetworkError(f"Unable to get URL ({resp.status_code})")
-
-    CONTENT_TYPE = resp.headers['Content-Type']
-    
-    if 'pdf' in CONTENT_TYPE:
-        return pdf_text(resp.content)
-    
-    if "html" not in CONTENT_TYPE:
-        logger.warning(url)
-        raise UnsupportedContentType(f"Unsupported content type: {resp.headers['Content-Type']}")
 
-    doc = Document(resp.text)
-    text = extract_text_from_html(doc.summary())
+def iter_text_from_html_lxml(content):
+    """
+    lxml equivalent of iter_text_from_html_bs4.
+    Walks the tree once generating text and tail strings in document order.
+    """
+    try:
+        root = lxml.html.fromstring(content)
+    except etree.ParserError:   # empty document
+        return
+
+    title = root.find('.//title')
+    if title is not None:
+        yield "Title: " + title.text_content()
+
+    def text(text, owner):
+        if text and owner is not None and owner.tag not in BLACKLIST:
+            return text + ' '
+
+    for event, el in etree.iterwalk(root, events=('start', 'end', 'comment', 'pi')):
+        if event == 'start':
+            t = text(el.text, el)
+        elif event == 'end':
+            # the tail follows the element and belongs to its parent
+            t = text(el.tail, el.getparent())
+        else:
+            # comments and processing instructions have no children;
+            # like bs4 their text is attributed to the enclosing element
+            t = (text(el.text, el.getparent()) or '') + (text(el.tail, el.getparent()) or '')
+        if t:
+            yield t
+
+
+def extract_text_from_html_lxml(content):
+    return "".join(iter_text_from_html_lxml(content))
+
+
+def iter_text_from_html(content, backend=None):
+    """
+    generate readable text strings from html content using the configured backend
+    """
+    if (backend or HTML_EXTRACT_BACKEND) == "bs4":
+        return iter_text_from_html_bs4(content)
+    return iter_text_from_html_lxml(content)
 
-    if not len(text) or text.isspace():
-        logger.warning(url)
-        raise EmptyText("Unable to extract text data from url")
-    return text
+
+def extract_text_from_html(content, backend=None):
+    """
+    extract readable text from html content using the configured backend
+    """
+    if (backend or HTML_EXTRACT_BACKEND) == "bs4":
+        return extract_text_from_html_bs4(content)
+    return extract_text_from_html_lxml(content)
 
 
+def get_url_text_chunks(url):
+    """
+    get url content and generate its readable text in chunks
+    """
+    # only download content types we know how to extract text from
+    resp = fetch(url, accept=['pdf', 'html'])
 
-def url_to_text(url):
+    if 'pdf' in resp.content_type:
+        yield from pdf_text_chunks(resp.content)
+        return
+
+    doc = Document(resp.text())
+    yield from iter_text_from_html(doc.summary())
+
+
+def url_text_chunks(url):
+    """
+    generate the readable text of the url in chunks using the appropriate extractor for the url
+    """
     HOPELESS = ["youtube.com",
                 "www.youtube.com"]
     if urllib.parse.urlparse(url).netloc in HOPELESS:
@@ -70,9 +141,34 @@ def url_to_text(url):
 
     if urllib.parse.urlparse(url).netloc == 'github.com':
         # for github repos use api to attempt to find a readme file
-        text = github_readme_text(url)
-    else:
-        text = get_url_text(url)
+        return github_readme_chunks(url)
+    return get_url_text_chunks(url)
+
+
+@metrics.stage("extract")
+def url_to_text(url, max_tokens=None):
+    """
+    extract and return the readable text of the url.
+    If max_tokens is specified, extraction stops once the running token estimate
+    of the text reaches max_tokens * EXTRACT_TOKEN_MARGIN since the caller will
+    truncate the text to max_tokens anyway.
+    """
+    max_chars = max_tokens * EXTRACT_TOKEN_MARGIN * CHARS_PER_TOKEN if max_tokens else None
+    chunks = []
+    size = 0
+    gen = url_text_chunks(url)
+    for chunk in gen:
+        chunks.append(chunk)
+        size += len(chunk)
+        if max_chars and size >= max_chars:
+            logger.info(f"url_to_text: stopping extraction at ~{size//CHARS_PER_TOKEN} tokens")
+            gen.close()
+            break
+    text = "".join(chunks)
+
+    if not len(text) or text.isspace():
+        logger.warning(url)
+        raise EmptyText("Unable to extract text data from url")
 
     logger.info("url_to_text: "+text)
     return text
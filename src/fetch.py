@@ -0,0 +1,130 @@
+#  Shared HTTP fetcher used for url text extraction
+#  Copyright (C) 2022 William S. Kish
+#
+#  All url fetches share one requests.Session so connections are pooled per host.
+#  Bodies are streamed with a byte cap, and the Content-Type is checked before
+#  any of the body is downloaded.
+
+import os
+import json
+import asyncio
+import requests
+from requests.adapters import HTTPAdapter
+from requests.utils import get_encoding_from_headers
+from loguru import logger
+
+from exceptions import *
+import metrics
+
+
+# Fetch Config
+FETCH_CONNECT_TIMEOUT  = float(os.environ.get("MASSGPT_FETCH_CONNECT_TIMEOUT", 5))
+FETCH_READ_TIMEOUT     = float(os.environ.get("MASSGPT_FETCH_READ_TIMEOUT", 30))
+FETCH_MAX_BYTES        = int(os.environ.get("MASSGPT_FETCH_MAX_BYTES", 20*1024*1024))
+FETCH_POOL_HOSTS       = int(os.environ.get("MASSGPT_FETCH_POOL_HOSTS", 32))  # number of per-host pools to keep
+FETCH_POOL_SIZE        = int(os.environ.get("MASSGPT_FETCH_POOL_SIZE", 8))    # connections kept per host
+FETCH_CHUNK_SIZE       = 64*1024
+
+
+_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections = FETCH_POOL_HOSTS,
+                       pool_maxsize     = FETCH_POOL_SIZE)
+_session.mount("http://",  _adapter)
+_session.mount("https://", _adapter)
+
+
+def session() -> requests.Session:
+    """
+    return the shared pooled session
+    """
+    return _session
+
+
+
+class FetchResponse:
+    """
+    The result of a fetch: the status, headers and the (size capped) body content
+    """
+    def __init__(self, url : str, status_code : int, headers, content : bytes) -> "FetchResponse":
+        self.url          = url
+        self.status_code  = status_code
+        self.headers      = headers
+        self.content      = content
+        self.content_type = headers.get('Content-Type', '')
+        self.encoding     = get_encoding_from_headers(headers)
+
+    def text(self) -> str:
+        """
+        return the content decoded per the response headers
+        """
+        return self.content.decode(self.encoding or 'utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+
+@metrics.stage("fetch")
+def fetch(url         : str,
+          accept      : list[str] = None,
+          headers     : dict = None,
+          max_bytes   : int = FETCH_MAX_BYTES,
+          ok_status   : tuple[int] = (200,)) -> FetchResponse:
+    """
+    fetch url via the shared session and return a FetchResponse.
+    accept is an optional list of Content-Type substrings that we are willing to download;
+    the body is not downloaded if the Content-Type doesn't match.
+    raises NetworkError if the url is unreachable or returns a status not in ok_status
+    raises UnsupportedContentType if the Content-Type is not accepted
+    raises ContentTooLarge if the body exceeds max_bytes
+    """
+    try:
+        resp = _session.get(url,
+                            headers = headers,
+                            stream  = True,
+                            timeout = (FETCH_CONNECT_TIMEOUT, FETCH_READ_TIMEOUT))
+    except requests.RequestException as e:
+        logger.warning(f"{url} {e}")
+        raise NetworkError(f"Unable to get URL ({e.__class__.__name__})")
+
+    with resp:
+        if resp.status_code not in ok_status:
+            logger.warning(url)
+            raise NetworkError(f"Unable to get URL ({resp.status_code})")
+
+        content_type = resp.headers.get('Content-Type', '')
+        if accept is not None and not any(a in content_type for a in accept):
+            logger.warning(url)
+            raise UnsupportedContentType(f"Unsupported content type: {content_type}")
+
+        length = resp.headers.get('Content-Length')
+        if length and length.isdigit() and int(length) > max_bytes:
+            logger.warning(f"{url} Content-Length {length}")
+            raise ContentTooLarge(f"Content too large ({length} bytes)")
+
+        chunks = []
+        size = 0
+        try:
+            for chunk in resp.iter_content(FETCH_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    logger.warning(f"{url} exceeded {max_bytes} bytes")
+                    raise ContentTooLarge(f"Content too large (> {max_bytes} bytes)")
+                chunks.append(chunk)
+        except requests.RequestException as e:
+            logger.warning(f"{url} {e}")
+            raise NetworkError(f"Unable to get URL ({e.__class__.__name__})")
+
+    return FetchResponse(url         = url,
+                         status_code = resp.status_code,
+                         headers     = resp.headers,
+                         content     = b"".join(chunks))
+
+
+
+async def afetch(url : str, **kwargs) -> FetchResponse:
+    """
+    async variant of fetch for use from the bot's event loop.
+    Runs the fetch in a worker thread so it shares the same connection pools.
+    """
+    return await asyncio.to_thread(fetch, url, **kwargs)
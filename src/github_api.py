@@ -1,11 +1,40 @@
 # wrangle text out of github repo readme via api
 # only works for repo readme, not other github pages like issues, discussions, etc
 
+import os
+import re
 from loguru import logger
-import requests
 import markdown 
 from bs4 import BeautifulSoup 
 
+from fetch import fetch
+from cache import LocalCache
+
+
+# GitHub Config
+GITHUB_TOKEN = os.environ.get("GITHUB_TOKEN")   # optional, raises the api rate limit
+GITHUB_CACHE_PATH      = os.environ.get("MASSGPT_GITHUB_CACHE_PATH", "github_cache.sqlite")
+GITHUB_CACHE_MAX_BYTES = int(os.environ.get("MASSGPT_GITHUB_CACHE_MAX_BYTES", 64*1024*1024))
+
+_readme_cache = None
+
+def readme_cache() -> LocalCache:
+    """
+    return the readme cache, opening it on first use.
+    Entries are keyed by owner/repo and hold the ETag and Last-Modified validators
+    along with the readme text rendered so far and the markdown sections not yet rendered.
+    """
+    global _readme_cache
+    if _readme_cache is None:
+        _readme_cache = LocalCache(GITHUB_CACHE_PATH, GITHUB_CACHE_MAX_BYTES)
+    return _readme_cache
+
+
+# markdown reference link definitions, e.g. "[1]: https://example.com"
+REFERENCE_DEF = re.compile(r"^ {0,3}\[[^\]]+\]:\s")
+# atx headings, e.g. "## Installation"
+HEADING = re.compile(r"^#{1,6}(\s|$)")
+
 
 def md_to_text(md):
     html = markdown.markdown(md)
@@ -13,7 +42,55 @@ def md_to_text(md):
     return soup.get_text()
 
 
-def github_readme_text(github_repo_url):
+def md_sections(md):
+    """
+    split markdown text into sections at headings outside of fenced code blocks.
+    Reference link definitions are appended to every section so links still render.
+    """
+    sections = [[]]
+    references = []
+    fence = None
+    for line in md.splitlines():
+        stripped = line.lstrip()
+        if fence:
+            if stripped.startswith(fence):
+                fence = None
+        elif stripped.startswith("```") or stripped.startswith("~~~"):
+            fence = stripped[:3]
+        elif HEADING.match(line) and sections[-1]:
+            sections.append([])
+        elif REFERENCE_DEF.match(line):
+            references.append(line)
+            continue
+        sections[-1].append(line)
+    return ["\n".join(section + [""] + references) for section in sections if section]
+
+
+def _readme_sections(key, entry, changed):
+    """
+    generate the rendered text of the readme sections in entry, rendering any
+    pending markdown sections as needed and saving the result back to the cache
+    """
+    try:
+        for text in list(entry['rendered']):
+            yield text
+        while entry['pending']:
+            text = md_to_text(entry['pending'][0]) + "\n"
+            entry['rendered'].append(text)
+            entry['pending'].pop(0)
+            changed = True
+            yield text
+    finally:
+        if changed:
+            readme_cache().put(key, entry)
+
+
+def github_readme_chunks(github_repo_url):
+    """
+    generate the readme text of a github repo one markdown section at a time.
+    The readme is revalidated against GitHub with a conditional request so an
+    unchanged readme is served from the cache.
+    """
     # split a github url into the owner and repo components
     # use the github api to try to find the readme text
     # ['https:', '', 'github.com', 'jiggy-ai', 'hn_summary']
@@ -23,12 +100,31 @@ def github_readme_text(github_repo_url):
         raise Exception(f"Unable to process github url {github_repo_url}")
     owner = spliturl[3]
     repo = spliturl[4]
+    key = f"{owner}/{repo}".lower()
     contenturl = f'https://api.github.com/repos/{owner}/{repo}/readme'
-    resp  = requests.get(contenturl)
-    if resp.status_code != 200:
-        logger.warning(f"{github_repo_url} {resp.content}")
-        raise Exception(f"Unable to get readme for {github_repo_url}")
-    item = resp.json()
-    md = requests.get(item['download_url']).text
-    return md_to_text(md)
 
+    # request the raw readme directly instead of following download_url
+    headers = {"Accept": "application/vnd.github.raw"}
+    if GITHUB_TOKEN:
+        headers["Authorization"] = f"Bearer {GITHUB_TOKEN}"
+    entry = readme_cache().get(key)
+    if entry:
+        if entry['etag']:
+            headers["If-None-Match"] = entry['etag']
+        if entry['last_modified']:
+            headers["If-Modified-Since"] = entry['last_modified']
+
+    resp = fetch(contenturl, headers=headers, ok_status=(200, 304))
+    if resp.status_code == 304:
+        logger.info(f"github readme not modified: {key}")
+        return _readme_sections(key, entry, changed=False)
+
+    entry = {"etag"          : resp.headers.get("ETag"),
+             "last_modified" : resp.headers.get("Last-Modified"),
+             "rendered"      : [],
+             "pending"       : md_sections(resp.text())}
+    return _readme_sections(key, entry, changed=True)
+
+
+def github_readme_text(github_repo_url):
+    return "".join(github_readme_chunks(github_repo_url))
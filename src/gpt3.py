@@ -3,12 +3,20 @@
 
 import os
 from loguru import logger
-from time import sleep
+from time import sleep, perf_counter
 
 import completion
 import openai
+from scheduler import scheduler
+import metrics
 
-openai.api_key = os.environ["OPENAI_API_KEY"]
+
+def check_config() -> None:
+    """
+    check the openai api configuration, raising KeyError if the api key is missing.
+    The openai module reads OPENAI_API_KEY from the environment on import.
+    """
+    openai.api_key = os.environ["OPENAI_API_KEY"]
 
 OPENAI_COMPLETION_MODELS = ["text-davinci-003", "text-davinci-002", "text-davinci-001"]
 
@@ -30,10 +38,14 @@ def CompletionLimits(min_prompt:int,
 
 RETRY_COUNT = 10
 
+# the completions api accepts at most 20 prompts per request
+OPENAI_MAX_BATCH = 20
+
 class GPT3CompletionTask(completion.CompletionTask):
     """
     An OpenAI GP3-class completion task implemented using OpenAI API
     """
+    MAX_BATCH = OPENAI_MAX_BATCH
 
     
     def __init__(self,
@@ -57,7 +69,32 @@ class GPT3CompletionTask(completion.CompletionTask):
         super().__init__(limits = limits,
                          model  = model)
 
+
+    def params(self) -> dict:
+        return {"temperature" : self.temperature,
+                "top_p"       : self.top_p,
+                "stop"        : self.stop}
         
+    def _retry(self, request):
+        """
+        perform the api request, retrying while the api is overloaded
+        """
+        for i in range(RETRY_COUNT):
+            try:
+                with metrics.stage("openai"):
+                    return request()
+            except (openai.error.RateLimitError, openai.error.ServiceUnavailableError) as e:
+                logger.warning("openai error")
+                metrics.OPENAI_RETRIES.labels(e.__class__.__name__).inc()
+                if i == RETRY_COUNT-1:
+                    raise
+                # hold back every other request as well while the api is overloaded
+                scheduler.backoff(i**1.3)
+                sleep(i**1.3)
+            except Exception as e:
+                logger.exception("_completion")
+                raise
+
     def _completion(self,
                     prompt                : str,                        
                     max_completion_tokens : int) -> str :
@@ -73,18 +110,49 @@ class GPT3CompletionTask(completion.CompletionTask):
                                             stop        = self.stop,
                                             max_tokens  = max_completion_tokens)
             return resp.choices[0].text
-            
-        for i in range(RETRY_COUNT):
-            try:
-                return completion()
-            except (openai.error.RateLimitError, openai.error.ServiceUnavailableError):
-                logger.warning("openai error")
-                if i == RETRY_COUNT-1:
-                    raise
-                sleep(i**1.3)
-            except Exception as e:
-                logger.exception("_completion")
-                raise
-            
 
-    
+        return self._retry(completion)
+
+    def _completion_stream(self,
+                           prompt                : str,
+                           max_completion_tokens : int):
+        """
+        perform the completion via the openai streaming api
+        generates the completion text deltas as they arrive
+        """
+        def completion():
+            return openai.Completion.create(engine      = self.model,
+                                            prompt      = prompt,
+                                            temperature = self.temperature,
+                                            top_p       = self.top_p,
+                                            stop        = self.stop,
+                                            max_tokens  = max_completion_tokens,
+                                            stream      = True)
+
+        t0 = perf_counter()
+        first = True
+        for resp in self._retry(completion):
+            if first:
+                metrics.observe("openai_first_delta", perf_counter() - t0)
+                first = False
+            yield resp.choices[0].text
+        metrics.observe("openai_stream", perf_counter() - t0)
+
+    def _completion_batch(self,
+                          prompts               : list[str],
+                          max_completion_tokens : int) -> list[str] :
+        """
+        perform completions for a list of prompts in a single openai api request
+        returns the completion text strings in prompt order
+        """
+        def completion():
+            resp = openai.Completion.create(engine      = self.model,
+                                            prompt      = prompts,
+                                            temperature = self.temperature,
+                                            top_p       = self.top_p,
+                                            stop        = self.stop,
+                                            max_tokens  = max_completion_tokens)
+            # choices are not guaranteed to be in prompt order
+            return [choice.text for choice in sorted(resp.choices, key=lambda c: c.index)]
+
+        return self._retry(completion)
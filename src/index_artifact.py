@@ -0,0 +1,116 @@
+#  Index artifacts
+#  Copyright (C) 2022 William S. Kish
+#
+#  An index snapshot file is stored as zlib-compressed chunks plus a JSON manifest
+#  recording the size and sha256 of each chunk and of the whole file.  Each artifact
+#  is stored under its own prefix, named by the file's sha256, so a new artifact never
+#  overwrites the chunks of an existing one.  The chunks are transferred through
+#  s3_bucket.Bucket's put_many/get_many, Bucket.max_concurrency() at a time.  The
+#  manifest is written last, so a manifest only exists for a complete artifact.
+#  Downloads verify every chunk and the reassembled file before moving it into place.
+
+import os
+import json
+import zlib
+import hashlib
+from loguru import logger
+
+from exceptions import ArtifactIntegrityError
+
+
+# Artifact Config
+ARTIFACT_CHUNK_SIZE  = int(os.environ.get("MASSGPT_ARTIFACT_CHUNK_SIZE", 8*1024*1024))   # uncompressed bytes per chunk
+ARTIFACT_COMPRESSION = 6                                                                # zlib level
+
+MANIFEST_FORMAT = 1
+
+
+def manifest_key(prefix : str) -> str:
+    return f"{prefix}/manifest.json"
+
+
+def upload(bucket, filename : str, prefix : str) -> str:
+    """
+    upload filename to the bucket as an artifact under prefix and the file's sha256.
+    Return the key of the artifact's manifest.
+    """
+    size = os.path.getsize(filename)
+    sha256 = _file_sha256(filename)
+    prefix = f"{prefix}-{sha256[:16]}"
+    count = -(-size // ARTIFACT_CHUNK_SIZE)    # chunks, rounding up
+    chunks = []
+    with open(filename, "rb") as f:
+        for group in range(0, count, bucket.max_concurrency()):
+            objects = {}
+            for index in range(group, min(count, group + bucket.max_concurrency())):
+                data = f.read(ARTIFACT_CHUNK_SIZE)
+                key = f"{prefix}/chunk-{index:05d}"
+                objects[key] = zlib.compress(data, ARTIFACT_COMPRESSION)
+                chunks.append({"key"             : key,
+                               "size"            : len(data),
+                               "compressed_size" : len(objects[key]),
+                               "sha256"          : hashlib.sha256(data).hexdigest()})
+            bucket.put_many(objects, content_type="application/octet-stream")
+
+    manifest = {"format"      : MANIFEST_FORMAT,
+                "compression" : "zlib",
+                "size"        : size,
+                "sha256"      : sha256,
+                "chunk_size"  : ARTIFACT_CHUNK_SIZE,
+                "chunks"      : chunks}
+    key = manifest_key(prefix)
+    bucket.put(key, json.dumps(manifest), content_type="application/json")
+    logger.info(f"artifact: {filename} {size} bytes as {len(chunks)} chunks "
+                f"{sum(c['compressed_size'] for c in chunks)} bytes compressed to {key}")
+    return key
+
+
+def download(bucket, key : str, filename : str) -> dict:
+    """
+    download the artifact with manifest key to filename, replacing it only once
+    the whole file has been verified.  Return the manifest.
+    raises ArtifactIntegrityError if any chunk or the file doesn't match the manifest
+    """
+    manifest = json.loads(bucket.get(key)[0])
+    if manifest.get("format") != MANIFEST_FORMAT or manifest.get("compression") != "zlib":
+        raise ArtifactIntegrityError(f"{key}: unsupported artifact format")
+    chunks = manifest["chunks"]
+    partial = f"{filename}.part"
+    try:
+        with open(partial, "wb") as f:
+            for group in range(0, len(chunks), bucket.max_concurrency()):
+                group_chunks = chunks[group:group + bucket.max_concurrency()]
+                objects = bucket.get_many([chunk["key"] for chunk in group_chunks])
+                for chunk in group_chunks:
+                    f.write(_chunk_data(chunk, objects[chunk["key"]][0]))
+        if os.path.getsize(partial) != manifest["size"] or _file_sha256(partial) != manifest["sha256"]:
+            raise ArtifactIntegrityError(f"{key}: file checksum mismatch")
+        os.replace(partial, filename)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    logger.info(f"artifact: {key} {manifest['size']} bytes to {filename}")
+    return manifest
+
+
+def _chunk_data(chunk : dict, compressed : bytes) -> bytes:
+    """
+    return the verified data of the chunk
+    raises ArtifactIntegrityError if it doesn't match the manifest
+    """
+    try:
+        data = zlib.decompress(compressed)
+    except zlib.error as e:
+        raise ArtifactIntegrityError(f"{chunk['key']}: corrupt chunk: {e}") from e
+    if len(data) != chunk["size"] or hashlib.sha256(data).hexdigest() != chunk["sha256"]:
+        raise ArtifactIntegrityError(f"{chunk['key']}: checksum mismatch")
+    return data
+
+
+def _file_sha256(filename : str) -> str:
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1024*1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
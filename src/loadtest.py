@@ -0,0 +1,89 @@
+"""
+Load test receive_message (and optionally summarize_url) end to end at high concurrency.
+
+Intended to be run against the local OpenAI stand-in (openai_standin.py) so it costs nothing:
+
+    python openai_standin.py --latency 2 --rate-429 0.05 &
+    OPENAI_API_BASE=http://localhost:8089/v1 OPENAI_API_KEY=standin python loadtest.py --concurrency 32 --requests 500
+
+Requires the usual MASSGPT_POSTGRES_* database config; load test users and messages
+are written to that database.
+"""
+
+import argparse
+from time import time
+from random import choice, random
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+from sqlmodel import Session, select
+
+from db import engine
+from models import User
+import massgpt
+
+
+TOPICS = ["rocket engines", "sourdough bread", "the best python web framework", "electric cars",
+          "chess openings", "learning rust", "remote work", "large language models"]
+
+
+def loadtest_user(n : int) -> User:
+    username = f"loadtest-{n}"
+    with Session(engine) as session:
+        user = session.exec(select(User).where(User.username == username)).first()
+        if not user:
+            user = User(username=username, first_name="load", last_name=str(n))
+            session.add(user)
+            session.commit()
+            session.refresh(user)
+    return user
+
+
+def percentile(values : list[float], p : float) -> float:
+    values = sorted(values)
+    return values[min(len(values)-1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int,   default=16)
+    parser.add_argument("--requests",    type=int,   default=200)
+    parser.add_argument("--users",       type=int,   default=20)
+    parser.add_argument("--url",         type=str,   default=None, help="url to summarize for a fraction of requests")
+    parser.add_argument("--url-rate",    type=float, default=0.1)
+    args = parser.parse_args()
+
+    users = [loadtest_user(n) for n in range(args.users)]
+    latencies = {"message": [], "url": []}
+    errors = Counter()
+
+    def request(i):
+        user = choice(users)
+        kind = "url" if args.url and random() < args.url_rate else "message"
+        t0 = time()
+        try:
+            if kind == "url":
+                massgpt.summarize_url(user, args.url)
+            else:
+                massgpt.receive_message(user, f"What do people think about {choice(TOPICS)}? ({i})")
+        except Exception as e:
+            errors[type(e).__name__] += 1
+            return
+        latencies[kind].append(time() - t0)
+
+    logger.remove()   # the per-message logging would dominate the output
+    t0 = time()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(request, range(args.requests)))
+    dt = time() - t0
+
+    print(f"{args.requests} requests in {dt:.1f}s  ({args.requests/dt:.1f} req/s) concurrency {args.concurrency}")
+    for kind, values in latencies.items():
+        if values:
+            print(f"{kind:8} n={len(values):5}  p50 {percentile(values, .5):6.2f}s  p95 {percentile(values, .95):6.2f}s  p99 {percentile(values, .99):6.2f}s")
+    for name, count in errors.most_common():
+        print(f"error {name}: {count}")
+
+
+if __name__ == "__main__":
+    main()
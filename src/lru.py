@@ -0,0 +1,55 @@
+#  In-process LRU cache
+#  Copyright (C) 2022 William S. Kish
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    A bounded mapping that evicts the least recently used entry once max_size
+    entries are held.  Safe for use from multiple threads.
+    """
+    def __init__(self, max_size : int) -> "LRUCache":
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        return the value for key, marking it most recently used, or default if not present
+        """
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def put(self, key, value) -> None:
+        """
+        store value for key, evicting the least recently used entry if full
+        """
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def values(self) -> list:
+        """
+        return a list of the values from least to most recently used
+        """
+        with self._lock:
+            return list(self._data.values())
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
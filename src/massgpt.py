@@ -2,11 +2,21 @@
 #
 #  Copyright (C) 2022 William S. Kish
 
-from sqlmodel import Session, select, delete
-from sentence_transformers import SentenceTransformer
+import os
+import json
+import zlib
+import base64
+import asyncio
+import queue
+import threading
+from time import perf_counter
+from sqlmodel import select, delete, or_
+from concurrent.futures import ThreadPoolExecutor
 import urllib.parse
+from uuid import uuid4
+import numpy as np
 
-from db import engine
+from db import async_session
 
 import gpt3
 
@@ -15,6 +25,13 @@ from models import *
 
 from extract import url_to_text
 from subprompt import SubPrompt
+from scheduler import Priority
+from completion import CompletionStream, CompletionBatcher
+from persist import PersistJob, PersistWriter
+from startup import LazyComponent
+from lru import LRUCache
+from bus import LocalBus
+import metrics
 
 
 ###
@@ -60,9 +77,11 @@ class SummarySubPrompt(SubPrompt):
     """
     SubPrompt Context for a system-generated summary
     """
+    PREFIX = "Here is a summary of previous discussions for reference: "
+
     @classmethod
     def from_msg(cls, text : str) -> "SubPrompt":
-        text = f"Here is a summary of previous discussions for reference: {text}"
+        text = SummarySubPrompt.PREFIX + text
         # don't need to specify max _tokens here since the summary is a model output
         # that is regulated through the msg_summary_limits        
         return SummarySubPrompt(text=text)
@@ -76,6 +95,7 @@ class MassGPTMessageTask(gpt3.GPT3CompletionTask):
     Generated message response completions based on dynamic history of recent messages and most used message
     """
     TEMPERATURE = 0.4
+    PRIORITY = Priority.interactive
     
     # General Prompt Strategy:
     #  Upon reception of message from a user 999, compose the following prompt
@@ -114,11 +134,12 @@ Users have recently said the following to you:""")
                          model      = 'text-davinci-003')
 
                  
-    def completion(self,
-                   recent_msgs : MessageResponseSubPrompt,
-                   user_msg    : MessageSubPrompt) -> Completion:
+    @metrics.stage("prompt_assembly")
+    def prompt(self,
+               recent_msgs : MessageResponseSubPrompt,
+               user_msg    : MessageSubPrompt) -> SubPrompt:
         """
-        return completion for the provided subprompts
+        return the prompt for the provided subprompts
         """
         prompt = MassGPTMessageTask.PREPROMPT
         final_prompt  = MassGPTMessageTask.PENULTIMATE_PROMPT
@@ -128,6 +149,12 @@ Users have recently said the following to you:""")
         logger.info(f"overhead tokens: {(prompt + final_prompt).tokens}")
         
         available_tokens = self.max_prompt_tokens() - (prompt + final_prompt).tokens
+        # the rolling summary of older messages leads the context and is kept if it fits
+        if recent_msgs and isinstance(recent_msgs[0], SummarySubPrompt):
+            summary, recent_msgs = recent_msgs[0], recent_msgs[1:]
+            if available_tokens - summary.tokens - 1 >= 0:
+                prompt += summary
+                available_tokens -= summary.tokens + 1
         logger.info(f"available_tokens: {available_tokens}")
         # assemble list of most recent_messages up to available token limit
         reversed_subs = []
@@ -147,7 +174,23 @@ Users have recently said the following to you:""")
 
         logger.info(f"final prompt token_count: {prompt.tokens}  chars: {len(prompt.text)}")
         
-        return super().completion(prompt)
+        return prompt
+
+    def completion(self,
+                   recent_msgs : MessageResponseSubPrompt,
+                   user_msg    : MessageSubPrompt) -> Completion:
+        """
+        return completion for the provided subprompts
+        """
+        return super().completion(self.prompt(recent_msgs, user_msg))
+
+    def completion_stream(self,
+                          recent_msgs : MessageResponseSubPrompt,
+                          user_msg    : MessageSubPrompt) -> CompletionStream:
+        """
+        return a CompletionStream for the provided subprompts
+        """
+        return super().completion_stream(self.prompt(recent_msgs, user_msg))
 
 
 
@@ -157,6 +200,52 @@ msg_response_task   = MassGPTMessageTask()
 
 
 
+## Map-Reduce URL Summary Config
+# text too long for a single summary prompt is split into at most URL_SUMMARY_MAP_CHUNKS chunks
+# that are summarized concurrently and then combined into one summary.  1 disables map-reduce.
+# The chunks of all urls being summarized are batched together by url_summary_map_batcher,
+# up to URL_SUMMARY_MAP_BATCH prompts per api request with at most URL_SUMMARY_MAP_PARALLEL
+# requests in flight.
+URL_SUMMARY_MAP_CHUNKS   = int(os.environ.get("MASSGPT_URL_SUMMARY_MAP_CHUNKS", 8))
+URL_SUMMARY_MAP_BATCH    = int(os.environ.get("MASSGPT_URL_SUMMARY_MAP_BATCH", 4))
+URL_SUMMARY_MAP_PARALLEL = int(os.environ.get("MASSGPT_URL_SUMMARY_MAP_PARALLEL", 4))
+
+
+class UrlSummaryMapTask(gpt3.GPT3CompletionTask):
+    """
+    Summarize one part of a long document as the map step of a map-reduce URL Summary
+    """
+    MAP_PROMPT_PREFIX = "The following is part {part} of {parts} of a long web document. Provide a detailed summary of this part, keeping the facts, names, numbers and conclusions that a summary of the whole document would need:"
+
+    TEMPERATURE = 0.2
+    CACHEABLE = True
+    PRIORITY = Priority.url_summary
+
+    def __init__(self) -> "UrlSummaryMapTask":
+        limits = gpt3.CompletionLimits(min_prompt     = 40,
+                                       min_completion = 200,
+                                       max_completion = 300)
+        
+        super().__init__(limits      = limits,
+                         temperature = UrlSummaryMapTask.TEMPERATURE,
+                         model      = 'text-davinci-003')
+
+    def max_chunk_tokens(self) -> int:
+        """
+        return the maximum size of a text chunk, leaving room for the prefix
+        """
+        prefix = SubPrompt(UrlSummaryMapTask.MAP_PROMPT_PREFIX.format(part=URL_SUMMARY_MAP_CHUNKS,
+                                                                      parts=URL_SUMMARY_MAP_CHUNKS))
+        return self.max_prompt_tokens() - prefix.tokens - 8
+
+    def prompt(self, part : int, parts : int, chunk : SubPrompt) -> SubPrompt:
+        return SubPrompt(UrlSummaryMapTask.MAP_PROMPT_PREFIX.format(part=part, parts=parts)) + chunk
+
+    def completion(self, part : int, parts : int, chunk : SubPrompt) -> Completion:
+        return super().completion(self.prompt(part, parts, chunk))
+
+    
+
 class UrlSummaryTask(gpt3.GPT3CompletionTask):
     """
     A Factory class to dynamically compose a prompt context for URL Summary task
@@ -168,8 +257,15 @@ class UrlSummaryTask(gpt3.GPT3CompletionTask):
     # prompt prefix for Github Readme files
     GITHUB_PROMPT_PREFIX = SubPrompt("Provide a summary of the following github project readme file, including the purpose of the project, what problems it may be used to solve, and anything the author mentions that differentiates this project from others:")
 
+    # inserted between the prefix and the partial summaries when reducing a map-reduce summary
+    REDUCE_PROMPT = SubPrompt("The content was too long to read at once, so here are summaries of each of its consecutive parts:")
+
     TEMPERATURE = 0.2
 
+    # re-summarizing the same url text should not cost another completion
+    CACHEABLE = True
+    PRIORITY = Priority.url_summary
+
     def __init__(self) -> "UrlSummaryTask":
         limits = gpt3.CompletionLimits(min_prompt     = 40,
                                        min_completion = 300,
@@ -179,12 +275,21 @@ class UrlSummaryTask(gpt3.GPT3CompletionTask):
                          temperature = UrlSummaryTask.TEMPERATURE,
                          model      = 'text-davinci-003')
 
+        self.map_task = UrlSummaryMapTask()
+
     def prefix(self, url):
         if urllib.parse.urlparse(url).netloc == 'github.com':
             return UrlSummaryTask.GITHUB_PROMPT_PREFIX
         else:
             return UrlSummaryTask.SUMMARIZE_PROMPT_PREFIX
 
+    def max_text_tokens(self) -> int:
+        """
+        return the maximum number of url text tokens that will be summarized
+        """
+        if URL_SUMMARY_MAP_CHUNKS < 2:
+            return self.max_prompt_tokens()
+        return URL_SUMMARY_MAP_CHUNKS * self.map_task.max_chunk_tokens()
 
     def completion(self, url: str, url_text : str) -> Completion:
         """
@@ -192,7 +297,31 @@ class UrlSummaryTask(gpt3.GPT3CompletionTask):
         The url is required in able to enable host-specific prompt strategy.
         For example a different prompt is used to summarize github repo's versus other web sites.
         """
+        url_text = SubPrompt(url_text)
         prompt = self.prefix(url) + url_text
+        if prompt.tokens > self.max_prompt_tokens() and URL_SUMMARY_MAP_CHUNKS > 1:
+            return self.map_reduce_completion(url, url_text)
+        prompt.truncate(self.max_prompt_tokens())
+        return super().completion(prompt)
+
+    def map_reduce_completion(self, url: str, url_text : SubPrompt) -> Completion:
+        """
+        summarize url_text that is too long for a single prompt by summarizing
+        token-bounded chunks of it concurrently and then summarizing the partial summaries
+        """
+        chunks = url_text.split(self.map_task.max_chunk_tokens())
+        if len(chunks) > URL_SUMMARY_MAP_CHUNKS:
+            logger.warning(f"map_reduce_completion: summarizing {URL_SUMMARY_MAP_CHUNKS} of {len(chunks)} chunks")
+            chunks = chunks[:URL_SUMMARY_MAP_CHUNKS]
+        logger.info(f"map_reduce_completion: {len(chunks)} chunks")
+
+        futures = [url_summary_map_batcher.submit(self.map_task.prompt(part+1, len(chunks), chunk))
+                   for part, chunk in enumerate(chunks)]
+        partials = [future.result() for future in futures]
+
+        prompt = self.prefix(url) + UrlSummaryTask.REDUCE_PROMPT
+        for part, partial in enumerate(partials):
+            prompt += f"Part {part+1}: {str(partial).strip()}"
         prompt.truncate(self.max_prompt_tokens())
         return super().completion(prompt)
 
@@ -201,158 +330,587 @@ class UrlSummaryTask(gpt3.GPT3CompletionTask):
 
 url_summary_task   =  UrlSummaryTask()
 
+url_summary_map_batcher = CompletionBatcher(url_summary_task.map_task,
+                                            max_batch = URL_SUMMARY_MAP_BATCH,
+                                            parallel  = URL_SUMMARY_MAP_PARALLEL)
+
+
+
+## Compaction Config
+# messages evicted from a context are summarized into a rolling summary at the head of the context.
+# Evicted messages are collected until there are at least COMPACTION_MIN_TOKENS of them.
+COMPACTION             = os.environ.get("MASSGPT_COMPACTION", "1") == "1"
+COMPACTION_MIN_TOKENS  = int(os.environ.get("MASSGPT_COMPACTION_MIN_TOKENS", 600))
+SUMMARY_MAX_TOKENS     = int(os.environ.get("MASSGPT_SUMMARY_MAX_TOKENS", 250))
+# tokens of recent messages kept in each context; 0 for as many as fit in a message prompt.
+# A smaller context relies more on the summary and gives shorter, faster prompts.
+CONTEXT_MAX_TOKENS     = int(os.environ.get("MASSGPT_CONTEXT_MAX_TOKENS", 0))
+
+
+class ChatSummaryTask(gpt3.GPT3CompletionTask):
+    """
+    Fold messages that have left a context into the context's rolling summary
+    """
+    SUMMARY_PROMPT_PREFIX = SubPrompt("The following messages were sent to MassGPT, a bot that relays messages between many users.")
+
+    PREVIOUS_SUMMARY_PROMPT = SubPrompt("Earlier messages were summarized as follows:")
+
+    MESSAGES_PROMPT = SubPrompt("These messages followed:")
+
+    SUMMARY_PROMPT = SubPrompt(f"Write a summary of the whole discussion in at most {SUMMARY_MAX_TOKENS*2//3} words. Keep the topics, questions, opinions and links that users may refer back to, and which users raised them:")
+
+    TEMPERATURE = 0.2
+    PRIORITY = Priority.background
+
+    def __init__(self) -> "ChatSummaryTask":
+        limits = gpt3.CompletionLimits(min_prompt     = 40,
+                                       min_completion = SUMMARY_MAX_TOKENS,
+                                       max_completion = SUMMARY_MAX_TOKENS)
+
+        super().__init__(limits      = limits,
+                         temperature = ChatSummaryTask.TEMPERATURE,
+                         model      = 'text-davinci-003')
+
+    def _prefix(self, summary : SubPrompt) -> SubPrompt:
+        prompt = ChatSummaryTask.SUMMARY_PROMPT_PREFIX
+        if summary is not None:
+            prompt += ChatSummaryTask.PREVIOUS_SUMMARY_PROMPT + summary.text.removeprefix(SummarySubPrompt.PREFIX)
+            prompt += ChatSummaryTask.MESSAGES_PROMPT
+        return prompt
+
+    def fit(self, summary : SubPrompt, sub_prompts : list[SubPrompt]) -> int:
+        """
+        return how many of the oldest sub_prompts fit in one prompt with the previous
+        summary, at least 1.  The rest are left for the next summary so that history
+        is folded in order and none is cut.
+        """
+        available_tokens = self.max_prompt_tokens() - (self._prefix(summary) + ChatSummaryTask.SUMMARY_PROMPT).tokens
+        count = 0
+        for sub in sub_prompts:
+            available_tokens -= sub.tokens + 1     # joined by newlines
+            if available_tokens < 0:
+                break
+            count += 1
+        return max(1, count)
+
+    def prompt(self, summary : SubPrompt, sub_prompts : list[SubPrompt]) -> SubPrompt:
+        """
+        return the prompt to fold sub_prompts into the previous summary, if any.
+        Use fit() to choose sub_prompts; a single sub prompt too large to fit is truncated.
+        """
+        prompt = self._prefix(summary)
+        available_tokens = self.max_prompt_tokens() - (prompt + ChatSummaryTask.SUMMARY_PROMPT).tokens
+        messages = SubPrompt("\n".join(sub.text for sub in sub_prompts))
+        messages.truncate(available_tokens)
+        return prompt + messages + ChatSummaryTask.SUMMARY_PROMPT
+
+    def completion(self, summary : SubPrompt, sub_prompts : list[SubPrompt]) -> Completion:
+        return super().completion(self.prompt(summary, sub_prompts))
+
+
+
+chat_summary_task  =  ChatSummaryTask()
+
+# contexts compacting at the same time share summary completion requests
+chat_summary_batcher = CompletionBatcher(chat_summary_task)
+
 
 
 ## Embedding Config
 ST_MODEL_NAME   =  'multi-qa-mpnet-base-dot-v1'
-st_model        =  SentenceTransformer(ST_MODEL_NAME)
 
+def _load_st_model():
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(ST_MODEL_NAME)
+
+# loaded on first use or by the bot's startup sequence
+st_model        =  LazyComponent("embedding_model", _load_st_model)
+
+
+def embed_text(text : str) -> list[float]:
+    return [float(x) for x in st_model().encode(text)]
+
+def unit_vector(vector) -> np.ndarray:
+    """
+    return vector scaled to unit length as float32, for cosine similarity by dot product
+    """
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector / (np.linalg.norm(vector) or 1)
 
+persist_writer = PersistWriter(embed_fn = embed_text)
+
+
+
+## Dedup Config
+# a message whose embedding has at least DEDUP_THRESHOLD cosine similarity with a message
+# already in the context is left out of the context.  1 disables semantic dedup.
+DEDUP_THRESHOLD = float(os.environ.get("MASSGPT_DEDUP_THRESHOLD", 0.95))
 
     
 class  Context():
     """
     A context for assembling a large prompt context from recent user message subprompts
+
+    The sub prompts and their token count are held as one immutable snapshot.
+    Readers take the current snapshot without locking; writers serialize on a lock,
+    build the next snapshot and publish it with a single assignment, so readers
+    never block on or observe a partial update.
     """
-    def __init__(self) -> "Context":
-        self.tokens  = 0
-        self._sub_prompts = []
+    def __init__(self, name : str = None) -> "Context":
+        self.name = name or DEFAULT_CONTEXT
+        self.max_tokens = CONTEXT_MAX_TOKENS or msg_response_task.max_prompt_tokens()
+        self._snapshot = ((), 0)       # (sub prompts oldest first, total tokens)
+        self._write_lock = threading.Lock()
+
+    def snapshot(self) -> tuple[tuple[SubPrompt], int]:
+        """
+        return the current (sub_prompts, tokens) snapshot
+        """
+        return self._snapshot
+
+    @property
+    def tokens(self) -> int:
+        return self._snapshot[1]
+
+    def summary(self) -> SummarySubPrompt:
+        """
+        return the rolling summary at the head of the context, or None
+        """
+        sub_prompts = self._snapshot[0]
+        if sub_prompts and isinstance(sub_prompts[0], SummarySubPrompt):
+            return sub_prompts[0]
+        return None
+
+    @staticmethod
+    def _duplicate(sub_prompts : tuple[SubPrompt], sub_prompt : SubPrompt) -> bool:
+        """
+        return True if sub_prompt is a near duplicate of any of sub_prompts by embedding
+        """
+        if DEDUP_THRESHOLD >= 1 or sub_prompt.embedding is None:
+            return False
+        vectors = [sub.embedding for sub in sub_prompts if sub.embedding is not None]
+        if not vectors:
+            return False
+        return float(np.max(np.stack(vectors) @ sub_prompt.embedding)) >= DEDUP_THRESHOLD
 
     def push(self, sub_prompt : SubPrompt) -> bool:
         """
-        Push sub_prompt onto begining of context.
+        Push sub_prompt onto begining of context, after the summary if there is one,
+        unless it duplicates a later sub prompt.
         Used to recreate context in reverse order from database select
         raises MaximumTokenLimit when prompt context limit is exceeded
         """
-        if self.tokens > msg_response_task.max_prompt_tokens():
-            raise MaximumTokenLimit
-        self._sub_prompts.insert(0, sub_prompt)
-        self.tokens += sub_prompt.tokens
+        with self._write_lock:
+            sub_prompts, tokens = self._snapshot
+            if tokens > self.max_tokens:
+                raise MaximumTokenLimit
+            if self._duplicate(sub_prompts, sub_prompt):
+                return
+            head = 1 if self.summary() else 0
+            self._snapshot = (sub_prompts[:head] + (sub_prompt,) + sub_prompts[head:], tokens + sub_prompt.tokens)
+
+    def _evict(self, sub_prompts : tuple[SubPrompt], tokens : int) -> tuple[SubPrompt]:
+        """
+        publish the snapshot of sub_prompts less the oldest sub prompts that don't fit,
+        keeping the summary.  Return the evicted sub prompts, oldest first.
+        """
+        head = 1 if sub_prompts and isinstance(sub_prompts[0], SummarySubPrompt) else 0
+        drop = head
+        while tokens > self.max_tokens and drop < len(sub_prompts) - 1:
+            tokens -= sub_prompts[drop].tokens
+            drop += 1
+        self._snapshot = (sub_prompts[:head] + sub_prompts[drop:], tokens)
+        return sub_prompts[head:drop]
         
-    def add(self, sub_prompt : SubPrompt) -> None:
-        # add new prompt to end of sub_prompts
-        self._sub_prompts.append(sub_prompt)
-        self.tokens += sub_prompt.tokens
-        # remove oldest subprompts if over prompt context limit exceeded
-        while self.tokens > msg_response_task.max_prompt_tokens():
-            self.tokens -= self._sub_prompts.pop(0).tokens
+    def add(self, sub_prompt : SubPrompt) -> tuple[SubPrompt]:
+        """
+        add sub_prompt to the end of the context, removing the oldest sub prompts if
+        the context is full, unless it duplicates a sub prompt already in the context.
+        Return the removed sub prompts.
+        """
+        with self._write_lock:
+            sub_prompts, tokens = self._snapshot
+            if self._duplicate(sub_prompts, sub_prompt):
+                logger.info(f"dedup: {sub_prompt.text[:80]}")
+                return ()
+            return self._evict(sub_prompts + (sub_prompt,), tokens + sub_prompt.tokens)
+
+    def set_summary(self, summary : SummarySubPrompt) -> tuple[SubPrompt]:
+        """
+        replace the rolling summary at the head of the context, removing the oldest
+        sub prompts if the context is full.  Return the removed sub prompts.
+        """
+        with self._write_lock:
+            sub_prompts, tokens = self._snapshot
+            current = self.summary()
+            if current:
+                sub_prompts, tokens = sub_prompts[1:], tokens - current.tokens
+            return self._evict((summary,) + sub_prompts, tokens + summary.tokens)
             
-    def sub_prompts(self) -> list[SubPrompt]:
-        return self._sub_prompts
+    def sub_prompts(self) -> tuple[SubPrompt]:
+        return self._snapshot[0]
 
-    
-##    
-### maintain a single global context (for now)
-##
-context = Context()
 
 
-    
-    
-def receive_message(user : User, text : str) -> str:
+## Context Config
+# messages are routed to named contexts, e.g. one per telegram group.
+# Messages stored before contexts were named belong to the DEFAULT_CONTEXT.
+DEFAULT_CONTEXT = "global"
+# at most MAX_CONTEXTS named contexts are kept in memory in addition to the default context;
+# the least recently used is dropped and reloaded from the database when next used
+MAX_CONTEXTS = int(os.environ.get("MASSGPT_MAX_CONTEXTS", 1000))
+
+
+# bus channel for context updates
+CONTEXT_CHANNEL = "massgpt_context"
+
+# SubPrompt types that can be shared over the bus, by name
+CONTEXT_SUB_PROMPTS = {cls.__name__: cls for cls in [SubPrompt,
+                                                     MessageSubPrompt,
+                                                     MessageResponseSubPrompt,
+                                                     UrlSummarySubPrompt,
+                                                     SummarySubPrompt]}
+
+
+class ContextRegistry:
     """
-    receive a message from the specified user.
-    Return the message response
+    The named contexts, loaded from the database on first use.
+    The default context is always resident.
+    Sub prompts added via add() and summaries set via set_summary() are published
+    on the bus so that the same context held by other worker processes stays current.
+    Each context is compacted by the one worker that owns it (see ContextCompactor.partition),
+    which summarizes the sub prompts evicted by every update to the context, so each
+    context's summary has a single writer.
+    """
+    def __init__(self, max_contexts : int, bus = None) -> "ContextRegistry":
+        self.default = Context(DEFAULT_CONTEXT)
+        self._contexts = LRUCache(max_contexts)
+        self._loads = {}   # name -> Task loading the context, so concurrent first messages share one load
+        self.origin = uuid4().hex
+        self.bus = None
+        self.attach(bus or LocalBus())
+
+    def attach(self, bus) -> None:
+        """
+        publish and receive context updates on bus
+        """
+        bus.subscribe(CONTEXT_CHANNEL, self._receive)
+        self.bus = bus
+
+    def add(self, context : Context, sub_prompt : SubPrompt) -> None:
+        """
+        add sub_prompt to the context here and in the other workers
+        """
+        compactor.submit(context, context.add(sub_prompt))
+        self._publish(context, sub_prompt)
+
+    def set_summary(self, context : Context, summary : SummarySubPrompt) -> None:
+        """
+        replace the rolling summary of the context here and in the other workers
+        """
+        compactor.submit(context, context.set_summary(summary))
+        self._publish(context, summary)
+
+    def _publish(self, context : Context, sub_prompt : SubPrompt) -> None:
+        update = {"origin"  : self.origin,
+                  "context" : context.name,
+                  "kind"    : sub_prompt.__class__.__name__,
+                  "text"    : sub_prompt.text,
+                  "tokens"  : sub_prompt.tokens}
+        payload = json.dumps(update, ensure_ascii=False)
+        if sub_prompt.embedding is not None:
+            # float16 halves the size of the embedding, but it can still push a long
+            # message over the bus payload limit; then it is sent without, and isn't deduped
+            update["embedding"] = base64.b64encode(sub_prompt.embedding.astype(np.float16).tobytes()).decode()
+            with_embedding = json.dumps(update, ensure_ascii=False)
+            max_payload = getattr(self.bus, "MAX_PAYLOAD", None)
+            if max_payload is None or len(with_embedding.encode()) <= max_payload:
+                payload = with_embedding
+        self.bus.publish(CONTEXT_CHANNEL, payload)
+
+    def _receive(self, payload : str) -> None:
+        update = json.loads(payload)
+        if update["origin"] == self.origin:
+            return
+        if update["context"] == DEFAULT_CONTEXT:
+            context = self.default
+        else:
+            # contexts that aren't resident will see the update when they are loaded from the database
+            context = self._contexts.get(update["context"])
+        if context is None:
+            if compactor.owns(update["context"]):
+                # the owner keeps its contexts resident so it sees their later evictions
+                asyncio.ensure_future(self.get(update["context"]))
+            return
+        sub_prompt = CONTEXT_SUB_PROMPTS[update["kind"]](update["text"], tokens=update["tokens"])
+        if "embedding" in update:
+            sub_prompt.embedding = unit_vector(np.frombuffer(base64.b64decode(update["embedding"]), dtype=np.float16))
+        if isinstance(sub_prompt, SummarySubPrompt):
+            compactor.submit(context, context.set_summary(sub_prompt))
+        else:
+            compactor.submit(context, context.add(sub_prompt))
+
+    async def _load(self, name : str) -> Context:
+        context = Context(name)
+        await load_context_from_db(context)
+        self._contexts.put(name, context)
+        return context
+
+    async def get(self, name : str = None) -> Context:
+        """
+        return the named context, loading it from the database if it isn't in memory
+        """
+        if name is None or name == DEFAULT_CONTEXT:
+            return self.default
+        context = self._contexts.get(name)
+        if context is not None:
+            return context
+        load = self._loads.get(name)
+        if load is None:
+            load = asyncio.ensure_future(self._load(name))
+            self._loads[name] = load
+            load.add_done_callback(lambda task: self._loads.pop(name, None))
+        return await asyncio.shield(load)
+
+
+contexts = ContextRegistry(MAX_CONTEXTS)
+
+
+
+class ContextCompactor:
+    """
+    Summarize the sub prompts evicted from contexts into each context's rolling
+    summary in the background.  Evictions are collected per context until
+    there are at least COMPACTION_MIN_TOKENS of them, so each summary completion
+    folds in a worthwhile amount of history.
+    The summary completions go through chat_summary_batcher so contexts compacting at
+    the same time share requests.  Each context has at most one summary in progress;
+    evictions arriving meanwhile, and any that didn't fit in its prompt, wait for the next one.
+    When workers share the contexts only the owner of a context compacts it.
+    """
+    def __init__(self) -> "ContextCompactor":
+        self._queue = queue.Queue()
+        self._pending = LRUCache(MAX_CONTEXTS + 1)   # context name -> evicted sub prompts not yet summarized
+        self._compacting = set()                     # names of contexts with a summary in progress
+        self._lock = threading.Lock()
+        self._pid = None                             # process the compaction thread was started in
+        self.worker = 0
+        self.workers = 1
+
+    def _start(self) -> None:
+        """
+        start the compaction thread on first use in each process
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def partition(self, worker : int, workers : int) -> None:
+        """
+        compact only the contexts owned by this worker when the contexts are shared
+        by the specified number of worker processes
+        """
+        self.worker = worker
+        self.workers = workers
+
+    def owns(self, name : str) -> bool:
+        """
+        return True if this worker compacts the named context
+        """
+        return zlib.crc32(name.encode()) % self.workers == self.worker
+
+    def submit(self, context : Context, evicted : tuple[SubPrompt]) -> None:
+        """
+        queue the sub prompts evicted from context for summarization if this worker owns it
+        """
+        if not COMPACTION or not evicted or not self.owns(context.name):
+            return
+        if self._pid != os.getpid():
+            self._start()
+        self._queue.put((context, evicted))
+
+    def _run(self) -> None:
+        while True:
+            context, evicted = self._queue.get()
+            if evicted is None:
+                # the context's summary in progress has finished
+                self._compacting.discard(context.name)
+                evicted = ()
+            pending = self._pending.pop(context.name, ()) + evicted
+            if context.name in self._compacting or sum(sub.tokens for sub in pending) < COMPACTION_MIN_TOKENS:
+                if pending:
+                    self._pending.put(context.name, pending)
+                continue
+            summary = context.summary()
+            count = chat_summary_task.fit(summary, pending)
+            if count < len(pending):
+                self._pending.put(context.name, pending[count:])
+                pending = pending[:count]
+            try:
+                future = chat_summary_batcher.submit(chat_summary_task.prompt(summary, pending))
+            except Exception:
+                logger.exception(f"compaction of {context.name} failed")
+                continue
+            self._compacting.add(context.name)
+            future.add_done_callback(lambda future, context=context, pending=pending, t0=perf_counter():
+                                     self._finish(context, pending, future, t0))
+
+    def _finish(self, context : Context, sub_prompts : tuple[SubPrompt], future, t0 : float) -> None:
+        try:
+            self.compact(context, sub_prompts, future.result())
+        except Exception:
+            logger.exception(f"compaction of {context.name} failed")
+        finally:
+            metrics.observe("compaction", perf_counter() - t0)
+            self._queue.put((context, None))
+
+    def compact(self, context : Context, sub_prompts : tuple[SubPrompt], completion : Completion) -> None:
+        """
+        persist the summary completion of sub_prompts and make it the context's summary
+        """
+        summary_text = str(completion).strip()
+        job = PersistJob()
+        completion_row = job.add(completion)
+        summary_row = job.add(ChatSummary(context = context.name),
+                              links = {"completion_id": completion_row})
+        job.add(Embedding(source     = EmbeddingSource.chat_summary,
+                          collection = ST_MODEL_NAME,
+                          model      = ST_MODEL_NAME),
+                links = {"source_id": summary_row},
+                embed = summary_text)
+        persist_writer.submit(job)
+        contexts.set_summary(context, SummarySubPrompt.from_msg(summary_text))
+        logger.info(f"compacted {len(sub_prompts)} sub prompts of {context.name}: {summary_text}")
+
+
+compactor = ContextCompactor()
+
+
+
+# computes the embeddings that dedup needs after the reply, in message order
+embedder = ThreadPoolExecutor(1, thread_name_prefix="embedder")
+
+
+def add_message(context    : Context,
+                sub_prompt : SubPrompt,
+                job        : PersistJob,
+                msg_row    : int,
+                text       : str) -> None:
+    """
+    add the message's sub_prompt, if any, to the shared context and persist the job
+    with the message embedding.
+    With dedup enabled this runs on the embedder, computing the embedding first so
+    the context can dedup the message.  Until the embedding model has loaded, messages
+    are added without dedup and the persist writer computes their embeddings.
+    """
+    vector = None
+    try:
+        if DEDUP_THRESHOLD < 1 and sub_prompt is not None and st_model.loaded():
+            with metrics.stage("embedding"):
+                vector = embed_text(text)
+            sub_prompt.embedding = unit_vector(vector)
+    except Exception:
+        logger.exception("dedup embedding failed")
+    try:
+        if sub_prompt is not None:
+            contexts.add(context, sub_prompt)
+    finally:
+        job.add(Embedding(source     = EmbeddingSource.message,
+                          collection = ST_MODEL_NAME,
+                          model      = ST_MODEL_NAME,
+                          vector     = vector),
+                links = {"source_id": msg_row},
+                embed = None if vector else text)
+        persist_writer.submit(job)
+
+
+def receive_message_stream(user : User, text : str, context : Context = None):
+    """
+    receive a message from the specified user in the specified context, by default
+    the default context.
+    Generate the message response text in deltas as the completion streams in.
+    The message, its embedding, the completion and the response are persisted
+    by the persist_writer after the response is complete.  The message joins the
+    context then too, or once its embedding is ready when dedup is enabled.
     """    
     logger.info(f"message from {user.id} {user.first_name} {user.last_name}: {text}")    
-    with Session(engine) as session:        
-        # persist msg to database so we can regain recent msg context after pod restart
-        msg = Message(text=text, user_id=user.id)
-        session.add(msg)
-        session.commit()
-        session.refresh(msg)
-                
-        # embedding should move to background work queue
-        t0 = time()
-        vector =  [float(x) for x in st_model.encode(msg.text)]
-        embedding = Embedding(source     = EmbeddingSource.message,
-                              source_id  = msg.id,
-                              collection = ST_MODEL_NAME,
-                              model      = ST_MODEL_NAME,
-                              vector     = vector)
-        logger.info(f"embedding dt: {time()-t0}")
-        session.add(embedding)
-        session.commit()
-        session.refresh(msg)
-
-    # build final aggregate prompt
-    msg_subprompt = MessageSubPrompt.from_msg(msg)
-    
-    completion = msg_response_task.completion(context.sub_prompts(), msg_subprompt)
-    logger.info(str(completion))
-    
-    # add the new user message to the global shared context
-    rsp_subprompt = MessageResponseSubPrompt.from_msg_completion(msg_subprompt, completion)
-    context.add(rsp_subprompt)
-
-    # save response to database
-    with Session(engine) as session:
-        session.add(completion)
-        session.commit()
-        session.refresh(completion)
-        session.add(Response(message_id=msg.id,
-                             completion_id=completion.id))
-        session.commit()
-        session.refresh(completion)
-        
-    return str(completion)
+    t0 = perf_counter()
+    context = context or contexts.default
+    msg = Message(text=text, user_id=user.id, context=context.name)
+    job = PersistJob()
+    msg_row = job.add(msg)
+    rsp_subprompt = None
+    try:
+        # build final aggregate prompt
+        msg_subprompt = MessageSubPrompt.from_msg(msg)
+
+        stream = msg_response_task.completion_stream(context.sub_prompts(), msg_subprompt)
+        yield from stream
+        completion = stream.completion
+        logger.info(str(completion))
+
+        rsp_subprompt = MessageResponseSubPrompt.from_msg_completion(msg_subprompt, completion)
+        completion_row = job.add(completion)
+        job.add(Response(), links = {"message_id"    : msg_row,
+                                     "completion_id" : completion_row})
+    finally:
+        # persist the msg even if there is no response so we can regain recent msg context after pod restart
+        if DEDUP_THRESHOLD < 1:
+            embedder.submit(add_message, context, rsp_subprompt, job, msg_row, msg.text)
+        else:
+            add_message(context, rsp_subprompt, job, msg_row, msg.text)
+    metrics.observe("receive_message", perf_counter() - t0)
+
+
+def receive_message(user : User, text : str, context : Context = None) -> str:
+    """
+    receive a message from the specified user.
+    Return the message response
+    """
+    return "".join(receive_message_stream(user, text, context))
 
     
 
 
-def summarize_url(user : User,  url : str) -> str:
+@metrics.stage("summarize_url")
+def summarize_url(user : User,  url : str, context : Context = None) -> str:
     """
     Summarize a url for a user.
-    Return the URL summary, adding the summary to the current context
+    Return the URL summary, adding the summary to the specified context, by default
+    the default context.
     """
+    context = context or contexts.default
     # check if message contains a URL
     # if so extract and summarize the contents
-    text = url_to_text(url)
-    with Session(engine) as session:
-        db_url = URL(url=url, user_id = user.id)
-        session.add(db_url)
-        session.commit()
-        session.refresh(db_url)
-        urltext = UrlText(url_id    = db_url.id,
-                          mechanism = "url_to_text",
-                          text      = text)
-        session.add(urltext)
-        session.commit()
-        session.refresh(urltext)
-
-    completion = url_summary_task.completion(url, text)
-
-    summary_text = str(completion)
-    
-    with Session(engine) as session:
-        session.add(completion)
-        session.commit()
-        session.refresh(completion)
-        
-        url_summary = UrlSummary(text_id = urltext.id,
-                                 user_id = user.id,
-                                 model   = url_summary_task.model,
-                                 prefix  = url_summary_task.prefix(url).text,
-                                 summary = summary_text)
-        session.add(url_summary)
-        session.commit()
-        session.refresh(url_summary)
-        
-        # embedding should move to background work queue
-        t0 = time()
-        vector =  [float(x) for x in st_model.encode(summary_text)]
-        embedding = Embedding(source     = EmbeddingSource.url_summary,
-                              source_id  = url_summary.id,
-                              collection = ST_MODEL_NAME,
-                              model      = ST_MODEL_NAME,
-                              vector     = vector)
-        logger.info(f"embedding dt: {time()-t0}")
-        session.add(embedding)
-        
-        session.commit()
+    text = url_to_text(url, max_tokens=url_summary_task.max_text_tokens())
+    job = PersistJob()
+    url_row = job.add(URL(url=url, user_id = user.id))
+    text_row = job.add(UrlText(mechanism = "url_to_text",
+                               text      = text[:65535]),   # UrlText.text max_length
+                       links = {"url_id": url_row})
+    try:
+        with metrics.stage("summarize"):
+            completion = url_summary_task.completion(url, text)
+        summary_text = str(completion)
+
+        job.add(completion)
+        summary_row = job.add(UrlSummary(user_id = user.id,
+                                         model   = url_summary_task.model,
+                                         prefix  = url_summary_task.prefix(url).text,
+                                         summary = summary_text),
+                              links = {"text_id": text_row})
+        job.add(Embedding(source     = EmbeddingSource.url_summary,
+                          collection = ST_MODEL_NAME,
+                          model      = ST_MODEL_NAME),
+                links = {"source_id": summary_row},
+                embed = summary_text)
+    finally:
+        persist_writer.submit(job)
 
     # add the summary to recent context    
-    context.add(UrlSummarySubPrompt.from_summary(user=user, text=summary_text))
+    contexts.add(context, UrlSummarySubPrompt.from_summary(user=user, text=summary_text))
 
     logger.info(summary_text)
     # send the text summary to the user as FYI
@@ -372,13 +930,15 @@ def current_prompts() -> str:
     
 
 
-def current_context(max_len=4096) -> str:
+def current_context(context : Context = None, max_len=4096) -> str:
     """
-    iterator returning max_len length strings of current context
+    iterator returning max_len length strings of the context, by default the default context
     """
+    context = context or contexts.default
+    sub_prompts, tokens = context.snapshot()
     size = 0
     text = ""
-    for sub in context.sub_prompts():
+    for sub in sub_prompts:
         if len(sub.text) + size > max_len:
             yield text
             text = ""
@@ -387,34 +947,78 @@ def current_context(max_len=4096) -> str:
         size += len(sub.text) + 1
     if text:
         yield text
-    yield f"{context.tokens} tokens"
+    yield f"{tokens} tokens"
 
     
     
-def load_context_from_db():
-    last = ""
-    logger.info('load_context_from_db')    
-    with Session(engine) as session:
-        for msg in session.exec(select(Message).order_by(Message.id.desc())):
-            try:
-                msg_subprompt = MessageSubPrompt.from_msg(msg)
-            except:
-                continue  # historic message to big for current limits
-            if msg_subprompt.text == last: continue  # basic dedup
-            last = msg_subprompt.text
-            resp = session.exec(select(Response).where(Response.message_id == msg.id)).first()
-            if not resp:
-                try:
-                    context.push(msg_subprompt)
-                except MaximumTokenLimit:
-                    break
-                continue
-            comp = session.exec(select(Completion).where(Completion.id == resp.completion_id)).first()
-            if not comp: continue
-            rsp_subprompt = MessageResponseSubPrompt.from_msg_completion(msg_subprompt, comp)
+# rows converted to sub prompts per worker thread call when a context is loaded
+LOAD_CONTEXT_BATCH = 100
+
+
+def _push_rows(context : Context, rows : list, last : str) -> tuple[bool, str]:
+    """
+    push the sub prompts of the message rows, newest first, onto the context.
+    Building the sub prompts tokenizes their text, so this runs in a worker thread
+    rather than on the event loop.
+    Return whether the context is full and the text of the last sub prompt pushed.
+    """
+    for msg, response_id, comp, vector in rows:
+        try:
+            msg_subprompt = MessageSubPrompt.from_msg(msg)
+        except:
+            continue  # historic message to big for current limits
+        if msg_subprompt.text == last: continue  # basic dedup
+        last = msg_subprompt.text
+        if vector:
+            msg_subprompt.embedding = unit_vector(vector)   # for semantic dedup by push
+        if response_id is None:
             try:
-                context.push(rsp_subprompt)
+                context.push(msg_subprompt)
             except MaximumTokenLimit:
+                return True, last
+            continue
+        if not comp: continue
+        rsp_subprompt = MessageResponseSubPrompt.from_msg_completion(msg_subprompt, comp)
+        try:
+            context.push(rsp_subprompt)
+        except MaximumTokenLimit:
+            return True, last
+    return False, last
+
+
+async def load_context_from_db(context : Context = None):
+    """
+    rebuild the context, by default the default context, from its latest summary and
+    most recent messages in the database.
+    The rows are fetched on the event loop and converted to sub prompts in worker threads.
+    """
+    context = context or contexts.default
+    last = ""
+    logger.info(f'load_context_from_db {context.name}')    
+    if context.name == DEFAULT_CONTEXT:
+        in_context = or_(Message.context == None, Message.context == DEFAULT_CONTEXT)
+    else:
+        in_context = Message.context == context.name
+    summary_query = select(Completion.completion) \
+                      .join(ChatSummary, ChatSummary.completion_id == Completion.id) \
+                      .where(ChatSummary.context == context.name) \
+                      .order_by(ChatSummary.id.desc()) \
+                      .limit(1)
+    query = select(Message, Response.id, Completion, Embedding.vector) \
+              .where(in_context) \
+              .outerjoin(Response, Response.message_id == Message.id) \
+              .outerjoin(Completion, Completion.id == Response.completion_id) \
+              .outerjoin(Embedding, (Embedding.source == EmbeddingSource.message) &
+                                    (Embedding.source_id == Message.id) &
+                                    (Embedding.collection == ST_MODEL_NAME)) \
+              .order_by(Message.id.desc())
+    async with async_session() as session:
+        summary_text = (await session.execute(summary_query)).scalar()
+        if summary_text:
+            context.set_summary(await asyncio.to_thread(SummarySubPrompt.from_msg, summary_text.strip()))
+        result = await session.stream(query)
+        async for rows in result.partitions(LOAD_CONTEXT_BATCH):
+            full, last = await asyncio.to_thread(_push_rows, context, rows, last)
+            if full:
                 break
-
-load_context_from_db()
+        await result.close()
@@ -0,0 +1,78 @@
+#  Metrics
+#  Copyright (C) 2022 William S. Kish
+#
+#  Per-stage latency histograms and event counters exported in the Prometheus
+#  text format.  Set MASSGPT_METRICS_PORT to serve them on http://host:port/metrics
+
+import os
+from time import perf_counter
+from contextlib import contextmanager
+from loguru import logger
+from prometheus_client import Histogram, Counter, Gauge, start_http_server
+
+
+# Metrics Config
+METRICS_PORT = int(os.environ.get("MASSGPT_METRICS_PORT", 0))   # 0 disables the endpoint
+
+# seconds; spans fast db inserts through slow map-reduce summaries
+STAGE_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 20, 40, 80, 160)
+
+
+# stages:
+#   embedding, prompt_assembly, openai, openai_first_delta, openai_stream, db_persist,
+#   fetch, extract, summarize, receive_message, summarize_url, compaction, telegram_wait
+STAGE_SECONDS = Histogram("massgpt_stage_seconds",
+                          "Latency of each stage of message and url processing",
+                          ["stage"],
+                          buckets = STAGE_BUCKETS)
+
+OPENAI_RETRIES = Counter("massgpt_openai_retries",
+                         "OpenAI requests retried because the api was overloaded",
+                         ["error"])
+
+TOKEN_LIMIT_REJECTIONS = Counter("massgpt_token_limit_rejections",
+                                 "Prompts rejected by CompletionLimits",
+                                 ["limit"])
+
+HANDLED_EXCEPTIONS = Counter("massgpt_handled_exceptions",
+                             "Exceptions handled by the bot handlers",
+                             ["handler", "exception"])
+
+TELEGRAM_RETRY_AFTER = Counter("massgpt_telegram_retry_after",
+                               "Telegram requests refused with RetryAfter by flood control")
+
+STARTUP_SECONDS = Gauge("massgpt_startup_seconds",
+                        "Time taken to initialize each startup component",
+                        ["component"])
+
+READY = Gauge("massgpt_ready", "1 once the bot is ready to answer messages")
+
+
+@contextmanager
+def stage(name : str):
+    """
+    time the enclosed block as the named stage.
+    The duration is recorded whether or not the block raises.
+    """
+    t0 = perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(name).observe(perf_counter() - t0)
+
+
+def observe(name : str, seconds : float) -> None:
+    """
+    record a stage duration measured by the caller
+    """
+    STAGE_SECONDS.labels(name).observe(seconds)
+
+
+def start_metrics_server(port_offset : int = 0) -> None:
+    """
+    serve the metrics on METRICS_PORT + port_offset if configured.
+    Worker processes each serve their own metrics on consecutive ports.
+    """
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT + port_offset)
+        logger.info(f"metrics on :{METRICS_PORT + port_offset}/metrics")
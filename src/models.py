@@ -27,7 +27,7 @@ class User(SQLModel, table=True):
     first_name:              Optional[str]        = Field(description="User's first name")
     last_name:               Optional[str]        = Field(description="User's last name")
     auth0_id:                Optional[str]        = Field(index=True, description='Auth0 user_id')    
-    telegram_id:             Optional[int]        = Field(sa_column=Column(BigInteger()), index=True, description='Telegram User ID')
+    telegram_id:             Optional[int]        = Field(sa_column=Column(BigInteger(), index=True, unique=True), description='Telegram User ID')
     telegram_is_bot:         Optional[bool]       = Field(description="is_bot from telegram")
     telegram_is_premium:     Optional[bool]       = Field(description="is_premium from telegram")
     telegram_language_code:  Optional[str]        = Field(description="language_code from telegram")
@@ -40,6 +40,7 @@ class Message(SQLModel, table=True):
     text:             str           = Field(max_length=4096, description='The message text')
     user_id:          int           = Field(index=True, foreign_key='user.id', description='The user who sent the Message')
     created_at:       timestamp     = Field(index=True, default_factory=time, description='The epoch timestamp when the Message was created.')
+    context:          Optional[str] = Field(default=None, index=True, max_length=256, description='The name of the context the Message was sent to; None for the default context.')
     
     
     
@@ -82,6 +83,7 @@ class ChatSummary(SQLModel, table=True):
     id:            int       = Field(primary_key=True, description="The ChatSummary unique id.")
     created_at:    timestamp = Field(index=True, default_factory=time, description='The epoch timestamp when this was created.')
     completion_id: int       = Field(foreign_key="completion.id", description="associated completion that provided the response text")
+    context:       Optional[str] = Field(default=None, index=True, max_length=256, description='The name of the context that was summarized; None for the default context.')
 
 
 
@@ -140,5 +142,6 @@ class HnswIndex(SQLModel, table=True):
                                   description='Unique database identifier for a given index')
     collection:       str = Field(index=True, description='The name of the collection that holds this vector.')
     count:            int = Field(default=0, description="The number of vectors included in the index.  The number of vectors in the collection at the time of index build.")
-    objkey:           str = Field(description='The index key name in object store')
+    objkey:           str = Field(description='The index key name in object store: the manifest_key for artifacts, otherwise the raw index file')
+    manifest_key:     Optional[str] = Field(default=None, description='The key of the manifest of the compressed, checksummed index artifact in object store, or None for a raw index file')
     created_at: timestamp = Field(default_factory=time, description='The epoch timestamp when the index was requested to be created.')
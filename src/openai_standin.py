@@ -0,0 +1,134 @@
+"""
+Local stand-in for the OpenAI completions api for offline load testing.
+
+Speaks enough of the completions protocol for the openai client used by gpt3.py,
+including list prompts and stream=True, with configurable latency, error rates
+and response lengths.  Point the app at it with:
+
+    OPENAI_API_BASE=http://localhost:8089/v1 OPENAI_API_KEY=standin
+
+usage: python openai_standin.py [--port 8089] [--latency 2.0] [--latency-sigma 0.5]
+                                [--rate-429 0.05] [--rate-503 0.02]
+                                [--min-tokens 50] [--max-tokens 300]
+"""
+
+import re
+import json
+import random
+import argparse
+from time import time, sleep
+from uuid import uuid4
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+WORDS = "the a model user message context summary prompt token reply people think about this that with from some more".split()
+
+COMPLETIONS_PATH = re.compile(r"^/v1/(engines/(?P<engine>[^/]+)/)?completions$")
+
+
+class StandInConfig:
+    latency       = 2.0     # median seconds per completion
+    latency_sigma = 0.5     # lognormal sigma of the latency distribution
+    rate_429      = 0.05    # fraction of requests that are rate limited
+    rate_503      = 0.02    # fraction of requests that fail as overloaded
+    min_tokens    = 50      # completion length range in tokens
+    max_tokens    = 300
+
+config = StandInConfig()
+
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status : int, body : dict) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status : int, message : str, error_type : str) -> None:
+        self.send_json(status, {"error": {"message" : message,
+                                          "type"    : error_type,
+                                          "param"   : None,
+                                          "code"    : None}})
+
+    def do_POST(self):
+        m = COMPLETIONS_PATH.match(self.path)
+        if not m:
+            return self.send_error_json(404, f"Unknown path {self.path}", "invalid_request_error")
+        req = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        model = m.group("engine") or req.get("model")
+
+        r = random.random()
+        if r < config.rate_429:
+            return self.send_error_json(429, "Rate limit reached (stand-in)", "requests")
+        if r < config.rate_429 + config.rate_503:
+            return self.send_error_json(503, "The server is overloaded or not ready yet (stand-in)", "server_error")
+
+        prompts = req.get("prompt", "")
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        max_tokens = req.get("max_tokens") or 16
+        lengths = [min(max_tokens, random.randint(config.min_tokens, config.max_tokens)) for p in prompts]
+        latency = random.lognormvariate(0, config.latency_sigma) * config.latency
+        texts = [" " + " ".join(random.choice(WORDS) for i in range(n)) for n in lengths]
+
+        base = {"id"      : f"cmpl-{uuid4().hex}",
+                "object"  : "text_completion",
+                "created" : int(time()),
+                "model"   : model}
+
+        if req.get("stream"):
+            return self.stream(base, texts, latency)
+
+        sleep(latency)
+        prompt_tokens = sum(len(p.split()) for p in prompts)
+        self.send_json(200, {**base,
+                             "choices" : [{"text"          : text,
+                                           "index"         : i,
+                                           "logprobs"      : None,
+                                           "finish_reason" : "length" if n == max_tokens else "stop"}
+                                          for i, (text, n) in enumerate(zip(texts, lengths))],
+                             "usage"   : {"prompt_tokens"     : prompt_tokens,
+                                          "completion_tokens" : sum(lengths),
+                                          "total_tokens"      : prompt_tokens + sum(lengths)}})
+
+    def stream(self, base : dict, texts : list[str], latency : float) -> None:
+        """
+        send the completions as server-sent events, one word per event,
+        spreading the latency over the words
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        events = [(i, " " + word) for i, text in enumerate(texts) for word in text.split()]
+        for i, delta in events:
+            sleep(latency / len(events))
+            chunk = {**base, "choices": [{"text": delta, "index": i, "logprobs": None, "finish_reason": None}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port",          type=int,   default=8089)
+    parser.add_argument("--latency",       type=float, default=config.latency)
+    parser.add_argument("--latency-sigma", type=float, default=config.latency_sigma)
+    parser.add_argument("--rate-429",      type=float, default=config.rate_429)
+    parser.add_argument("--rate-503",      type=float, default=config.rate_503)
+    parser.add_argument("--min-tokens",    type=int,   default=config.min_tokens)
+    parser.add_argument("--max-tokens",    type=int,   default=config.max_tokens)
+    args = parser.parse_args()
+    for k, v in vars(args).items():
+        setattr(config, k, v)
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), StandInHandler)
+    print(f"OpenAI stand-in listening on http://127.0.0.1:{args.port}/v1")
+    server.serve_forever()
@@ -1,20 +1,120 @@
 
 from loguru import logger
-from io import BytesIO 
+from io import BytesIO
+import os
+import threading
+import tempfile
+from collections import deque, Counter
+import multiprocessing
+import multiprocessing.pool
+from time import time
 from pdfminer.high_level import extract_pages
 from pdfminer.layout import LTTextContainer
+from pdfminer.pdfpage import PDFPage
+
+
+# PDF Extraction Config
+PDF_WORKERS        = int(os.environ.get("MASSGPT_PDF_WORKERS", os.cpu_count() or 2))
+PDF_PAGES_PER_TASK = int(os.environ.get("MASSGPT_PDF_PAGES_PER_TASK", 4))
+PDF_MAX_PAGES      = int(os.environ.get("MASSGPT_PDF_MAX_PAGES", 100))
+PDF_TIME_BUDGET    = float(os.environ.get("MASSGPT_PDF_TIME_BUDGET", 20))   # seconds
+
+_pool = None                    # the pool new extractions use
+_pool_users = Counter()         # pool -> extractions using it
+_pool_lock = threading.Lock()
+
+def _acquire_pool() -> multiprocessing.pool.Pool:
+    """
+    return the current pool, creating it if needed, and count the caller as one of its users
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawned workers don't inherit the threads and locks of the (threaded) bot process
+            _pool = multiprocessing.get_context("spawn").Pool(PDF_WORKERS)
+        _pool_users[_pool] += 1
+        return _pool
+
+def _release_pool(pool : multiprocessing.pool.Pool, retire : bool = False) -> None:
+    """
+    stop using the pool.  If retire is True the pool may have a worker stuck on a
+    pathological pdf, so new extractions get a new pool.  A retired pool is terminated,
+    killing any stuck worker, once the extractions still using it have finished, so
+    one bad pdf doesn't cost the others their work.
+    """
+    global _pool
+    with _pool_lock:
+        _pool_users[pool] -= 1
+        if retire and _pool is pool:
+            _pool = None
+        terminate = _pool_users[pool] == 0 and _pool is not pool
+        if _pool_users[pool] == 0:
+            del _pool_users[pool]
+    if terminate:
+        pool.terminate()
+
+
+def _pages_text(pdf_path : str, page_numbers : list[int]) -> str:
+    """
+    extract the text of the specified pages of the pdf file.
+    Runs in a pool worker process.
+    """
+    text = []
+    with open(pdf_path, 'rb') as f:
+        for page_layout in extract_pages(f, page_numbers=page_numbers, maxpages=page_numbers[-1]+1):
+            for element in page_layout:
+                if isinstance(element, LTTextContainer):
+                    for text_line in element:
+                        text.append(text_line.get_text().rstrip())
+                        text.append(" ")
+    return "".join(text)
+
+
+def pdf_text_chunks(pdf_bytes):
+    """
+    generate the text of the pdf in page order, one page range at a time.
+    The page ranges are extracted in parallel in a process pool.  At most PDF_WORKERS
+    ranges are in flight so a consumer that stops early doesn't leave the pool
+    busy with pages that will never be read.
+    At most PDF_MAX_PAGES are extracted.  If PDF_TIME_BUDGET is exceeded the
+    generator stops after the leading page ranges completed so far.
+    """
+    t0 = time()
+    npages = sum(1 for _ in PDFPage.get_pages(BytesIO(pdf_bytes), maxpages=PDF_MAX_PAGES))
+    if npages == PDF_MAX_PAGES:
+        logger.warning(f"pdf_text: limiting extraction to {PDF_MAX_PAGES} pages")
+    page_ranges = deque(list(range(i, min(i+PDF_PAGES_PER_TASK, npages))) for i in range(0, npages, PDF_PAGES_PER_TASK))
+
+    # workers read the pdf from a temp file rather than pickling the bytes for each task
+    with tempfile.NamedTemporaryFile(suffix=".pdf") as f:
+        f.write(pdf_bytes)
+        f.flush()
+        pool = _acquire_pool()
+        retire = False
+        try:
+            pending = deque()   # results of the page ranges in flight, in page order
+            completed = 0
+            while page_ranges or pending:
+                while page_ranges and len(pending) < PDF_WORKERS:
+                    pending.append(pool.apply_async(_pages_text, (f.name, page_ranges.popleft())))
+                try:
+                    text = pending[0].get(timeout=max(0, t0 + PDF_TIME_BUDGET - time()))
+                except multiprocessing.TimeoutError:
+                    logger.warning(f"pdf_text: time budget exceeded after {completed} page ranges")
+                    retire = True
+                    return
+                pending.popleft()
+                completed += 1
+                yield text
+        finally:
+            _release_pool(pool, retire)
+    logger.info(f"pdf_text: {npages} pages in {time()-t0:.2f}s")
 
 
 def pdf_text(pdf_bytes):
     """
     extract text from the pdf_bytes and return it as a single string
     """
-    text = ""
-    for page_layout in extract_pages(BytesIO(pdf_bytes)):
-        for element in page_layout:
-            if isinstance(element, LTTextContainer):
-                for text_line in element:
-                    text += text_line.get_text().rstrip() + " "
-                    
+    text = "".join(pdf_text_chunks(pdf_bytes))
     logger.info("pdf_text: "+text)
     return text
@@ -0,0 +1,282 @@
+#  Write-behind persistence
+#  Copyright (C) 2022 William S. Kish
+#
+#  The rows produced by handling a message or url (Message, Embedding, Completion,
+#  Response, URL, UrlText, UrlSummary) are collected into a PersistJob and handed to
+#  the PersistWriter instead of being written on the reply path.  A background thread
+#  writes all queued jobs in one transaction every PERSIST_FLUSH_INTERVAL seconds.
+#  Jobs from a failed flush are kept in a spool file and retried with backoff
+#  until they are written, including across process restarts.
+
+import os
+import json
+import queue
+import atexit
+import threading
+from decimal import Decimal
+from loguru import logger
+from pydantic import validate_model
+from sqlmodel import Session, SQLModel
+from sqlalchemy.exc import OperationalError
+
+import models
+import metrics
+from db import engine
+
+
+# Persistence Config
+PERSIST_WRITE_BEHIND   = os.environ.get("MASSGPT_PERSIST_WRITE_BEHIND", "1") == "1"   # 0 writes each job synchronously
+PERSIST_FLUSH_INTERVAL = float(os.environ.get("MASSGPT_PERSIST_FLUSH_INTERVAL", 0.5))   # seconds
+PERSIST_MAX_BATCH      = int(os.environ.get("MASSGPT_PERSIST_MAX_BATCH", 200))          # jobs per transaction
+PERSIST_SPOOL_PATH     = os.environ.get("MASSGPT_PERSIST_SPOOL_PATH", "persist_spool.jsonl")
+PERSIST_MAX_BACKOFF    = 60   # seconds
+
+
+def _json_default(value):
+    # as a string so the decimal places survive the round trip
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(f"{value.__class__.__name__} is not JSON serializable")
+
+
+def _model_fields(cls, fields : dict) -> dict:
+    """
+    return fields with float values of decimal fields, e.g. the created_at timestamps,
+    quantized to the field's decimal places.  Model validation rejects them otherwise,
+    and a table model drops rejected values without an error.
+    """
+    for name, value in fields.items():
+        field = cls.__fields__[name]
+        if isinstance(value, float) and issubclass(field.type_, Decimal) and field.type_.decimal_places is not None:
+            fields[name] = Decimal(repr(value)).quantize(Decimal(1).scaleb(-field.type_.decimal_places))
+    return fields
+
+
+class PersistJob:
+    """
+    An ordered list of rows to be written together.
+    Rows can reference the ids of earlier rows in the job via links, since the ids
+    aren't known until the rows are inserted, and can request that their embedding
+    vector be computed by the writer.
+    Jobs are kept in serialized form so they can be retried and spooled.
+    """
+    def __init__(self) -> "PersistJob":
+        self.rows = []     # [model name, fields, {field: source row index}, embed text]
+
+    def add(self,
+            row   : SQLModel,
+            links : dict[str, int] = None,
+            embed : str = None) -> int:
+        """
+        add row to the job, returning its index for use in links of later rows.
+        links maps fields of this row to the index of the earlier row whose id they take.
+        If embed is specified the row's vector is set to the embedding of the embed text.
+        raises pydantic.ValidationError if a field would not survive being written
+        """
+        fields = _model_fields(row.__class__, row.dict(exclude={"id"}, exclude_none=True))
+        # fields that fail validation when the row is rebuilt from its spooled form would be dropped
+        values, fields_set, error = validate_model(row.__class__, json.loads(json.dumps(fields, default=_json_default)))
+        if fields.keys() - values.keys():
+            raise error
+        self.rows.append([row.__class__.__name__, fields, links or {}, embed])
+        return len(self.rows) - 1
+
+    def dumps(self) -> str:
+        return json.dumps(self.rows, default=_json_default)
+
+    @classmethod
+    def loads(cls, data : str) -> "PersistJob":
+        job = cls()
+        job.rows = json.loads(data)
+        return job
+
+    def embed(self, embed_fn) -> None:
+        """
+        compute any requested embedding vectors, storing them in the job.
+        A row whose embedding fails is left out of the job rather than written without it.
+        """
+        for row in self.rows:
+            if row[0] is not None and row[3] is not None:
+                try:
+                    with metrics.stage("embedding"):
+                        row[1]["vector"] = embed_fn(row[3])
+                    row[3] = None
+                except Exception:
+                    logger.exception(f"persist: embedding failed, skipping {row[0]} row")
+                    row[0] = None
+
+    def apply(self, session : Session, isolate : bool = False) -> None:
+        """
+        add the job's rows to the session, flushing as needed to resolve links.
+        If isolate is True each row is written in its own savepoint and a row that
+        fails is skipped.  Rows skipped by embed() or here are left out along with
+        the rows that link to them.
+        """
+        sources = {index for name, fields, links, embed in self.rows for index in links.values()}
+        instances = []
+        for index, (name, fields, links, embed) in enumerate(self.rows):
+            if name is None or any(instances[source] is None for source in links.values()):
+                instances.append(None)
+                continue
+            if isolate:
+                try:
+                    with session.begin_nested():
+                        row = self._build(name, fields, links, instances)
+                        session.add(row)
+                        session.flush()
+                except OperationalError:
+                    raise
+                except Exception:
+                    logger.exception(f"persist: skipping {name} row {json.dumps(fields, default=_json_default)[:1000]}")
+                    row = None
+            else:
+                row = self._build(name, fields, links, instances)
+                session.add(row)
+                if index in sources:
+                    session.flush()
+            instances.append(row)
+
+    @staticmethod
+    def _build(name : str, fields : dict, links : dict[str, int], instances : list[SQLModel]) -> SQLModel:
+        cls = getattr(models, name)
+        row = cls(**_model_fields(cls, dict(fields)))
+        for field, source in links.items():
+            setattr(row, field, instances[source].id)
+        return row
+
+
+
+class PersistWriter:
+    """
+    Write PersistJobs in batches from a background thread.
+    embed_fn(text) -> list[float] computes embeddings requested by jobs.
+    """
+    def __init__(self, embed_fn) -> "PersistWriter":
+        self.embed_fn = embed_fn
+        self._queue = queue.Queue()
+        self._wake = threading.Event()
+        self._lock = threading.Lock()       # serializes flushes
+        self._failed = []                   # jobs awaiting retry, oldest first; loaded from the spool on start
+        self._backoff = 0
+        self._pid = None                    # process the writer thread was started in
+        self.spool_path = PERSIST_SPOOL_PATH  # worker processes each need their own spool
+
+    def _start(self) -> None:
+        """
+        start the writer thread on first use in each process, since a forked
+        worker doesn't inherit its parent's threads
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._failed = self._load_spool()
+            threading.Thread(target=self._run, daemon=True).start()
+            atexit.register(self.flush)
+
+    def submit(self, job : PersistJob) -> None:
+        """
+        persist the job, in the background if write-behind is enabled
+        """
+        if not PERSIST_WRITE_BEHIND:
+            job.embed(self.embed_fn)
+            self._write([job])
+            return
+        if self._pid != os.getpid():
+            self._start()
+        self._queue.put(job)
+        if self._queue.qsize() >= PERSIST_MAX_BATCH and not self._backoff:
+            self._wake.set()
+
+    def flush(self) -> bool:
+        """
+        write up to PERSIST_MAX_BATCH queued jobs along with any previously failed jobs.
+        Return False if the database was unavailable, in which case the jobs are
+        spooled for a later retry.
+        """
+        with self._lock:
+            jobs = []
+            while len(jobs) < PERSIST_MAX_BATCH:
+                try:
+                    jobs.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not jobs and not self._failed:
+                return True
+            for job in jobs:
+                job.embed(self.embed_fn)
+            batch = self._failed + jobs
+            try:
+                self._write(batch)
+                remaining = []
+            except OperationalError as e:
+                logger.warning(f"persist: database unavailable: {e.__class__.__name__}")
+                remaining = batch
+            except Exception:
+                # a bad row fails the whole transaction; isolate it by writing each row separately
+                logger.exception("persist: batch failed, writing rows individually")
+                remaining = self._write_each(batch)
+            if remaining or self._failed:
+                self._save_spool(remaining)
+            self._failed = remaining
+            if remaining:
+                logger.warning(f"persist: {len(remaining)} jobs awaiting retry")
+            return not remaining
+
+    def _write(self, jobs : list[PersistJob], isolate : bool = False) -> None:
+        with metrics.stage("db_persist"), Session(engine) as session:
+            for job in jobs:
+                job.apply(session, isolate)
+            session.commit()
+
+    def _write_each(self, jobs : list[PersistJob]) -> list[PersistJob]:
+        """
+        write jobs in separate transactions, skipping the rows that fail.
+        Returns the unwritten jobs if the database becomes unavailable.
+        """
+        for i, job in enumerate(jobs):
+            try:
+                self._write([job], isolate=True)
+            except OperationalError:
+                return jobs[i:]
+            except Exception:
+                logger.exception(f"persist: discarding job {job.dumps()[:1000]}")
+        return []
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(self._backoff or PERSIST_FLUSH_INTERVAL)
+            self._wake.clear()
+            try:
+                ok = self.flush()
+            except Exception:
+                logger.exception("persist")
+                ok = False
+            self._backoff = 0 if ok else min(PERSIST_MAX_BACKOFF, max(1, self._backoff * 2))
+            if ok and self._queue.qsize() >= PERSIST_MAX_BATCH:
+                self._wake.set()
+
+    def _load_spool(self) -> list[PersistJob]:
+        if not os.path.exists(self.spool_path):
+            return []
+        with open(self.spool_path) as f:
+            jobs = [PersistJob.loads(line) for line in f if line.strip()]
+        if jobs:
+            logger.info(f"persist: {len(jobs)} spooled jobs to retry")
+        return jobs
+
+    def _save_spool(self, jobs : list[PersistJob]) -> None:
+        """
+        replace the spool file contents with the jobs
+        """
+        if not jobs:
+            if os.path.exists(self.spool_path):
+                os.remove(self.spool_path)
+            return
+        tmp = self.spool_path + ".tmp"
+        with open(tmp, "w") as f:
+            for job in jobs:
+                f.write(job.dumps() + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.spool_path)
@@ -9,6 +9,8 @@ import wikipedia
     
 
 class SubjectQueryTask(GPT3CompletionTask):
+    CACHEABLE = True
+    
     def __init__(self,
                  min_completion=100,
                  max_completion=100) -> "SubjectQueryTask":
@@ -39,6 +41,7 @@ class WikipediaQueryTask(GPT3CompletionTask):
     Generated message response completions based on dynamic history of recent messages and most used message
     """
     TEMPERATURE = 0.0
+    CACHEABLE = True
     
     def __init__(self,
                  wikipedia_page:str, 
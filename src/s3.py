@@ -1,6 +1,6 @@
 import s3_bucket as S3
-import boto3
 import os
+from loguru import logger
 from botocore.exceptions import ClientError
 
 BUCKET_NAME = 'jiggy-assets'
@@ -18,15 +18,6 @@ S3.Bucket.prepare(STORAGE_KEY_ID,
 bucket = S3.Bucket(BUCKET_NAME)
 
 
-linode_obj_config = {
-    "aws_access_key_id": STORAGE_KEY_ID,
-    "aws_secret_access_key": STORAGE_SECRET_KEY,
-    "endpoint_url": ENDPOINT_URL}
-
-
-s3_client = boto3.client('s3', **linode_obj_config)
-
-
 def create_presigned_url(object_name, expiration=300):
     """
     Generate a presigned URL to share an S3 object
@@ -37,12 +28,12 @@ def create_presigned_url(object_name, expiration=300):
 
     # Generate a presigned URL for the S3 object
     try:
-        response = s3_client.generate_presigned_url('get_object',
-                                                    Params={'Bucket': BUCKET_NAME,
-                                                            'Key': object_name},
-                                                    ExpiresIn=expiration)
+        response = S3.Bucket.client().generate_presigned_url('get_object',
+                                                             Params={'Bucket': BUCKET_NAME,
+                                                                     'Key': object_name},
+                                                             ExpiresIn=expiration)
     except ClientError as e:
-        logging.error(e)
+        logger.error(e)
         return None
 
     # The response contains the presigned URL
@@ -1,17 +1,40 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
-from typing import Union, Dict
+from typing import Union, Dict, List
 from . import exceptions
 
 
+MB = 1024 * 1024
+
+
 class Bucket:
     """
     CLASS THAT HANDLES S3 BUCKET TRANSACTIONS. ABSTRACTS AWAY BOTO3'S ARCANE BS.
     HANDLES BOTO3'S EXCEPTIONS WITH CUSTOM EXCEPTION CLASSES TO MAKE CODE USABLE
+
+    ONE BOTO3 SESSION AND CLIENT ARE SHARED BY ALL BUCKETS AND THREADS OF A PROCESS SO CONNECTIONS
+    ARE REUSED. LARGE FILES ARE TRANSFERRED IN PARTS, MAX_CONCURRENCY PARTS AT A TIME.
     """
     _AWS_ACCESS_KEY_ID = None
     _AWS_SECRET_ACCESS_KEY = None
+    _AWS_SESSION_TOKEN = None
     _ENDPOINT_URL = None
+
+    # TRANSFER TUNING
+    _MAX_CONCURRENCY = 10               # PARTS OF ONE FILE OR OBJECTS OF A BATCH TRANSFERRED AT ONCE
+    _MULTIPART_THRESHOLD = 16 * MB      # FILES THIS LARGE ARE TRANSFERRED IN PARTS
+    _MULTIPART_CHUNKSIZE = 16 * MB
+
+    # CACHED PER PROCESS, SINCE BOTO3 SESSIONS DON'T SURVIVE A FORK
+    _LOCK = threading.Lock()
+    _PID = None
+    _CLIENT = None
+    _TRANSFER_CONFIG = None
     
     def __init__(self, bucket_name: str):
 
@@ -22,29 +45,60 @@ class Bucket:
         self.bucket_name = bucket_name
 
     @classmethod
-    def prepare(cls, aws_access_key_id: str, aws_secret_access_key: str, aws_session_token=None, endpoint_url=None):
+    def prepare(cls, aws_access_key_id: str, aws_secret_access_key: str, aws_session_token=None, endpoint_url=None,
+                max_concurrency: int = None, multipart_threshold: int = None, multipart_chunksize: int = None):
         cls._AWS_ACCESS_KEY_ID = aws_access_key_id
         cls._AWS_SECRET_ACCESS_KEY = aws_secret_access_key
         cls._AWS_SESSION_TOKEN = aws_session_token
         cls._ENDPOINT_URL = endpoint_url
+        cls._MAX_CONCURRENCY = max_concurrency or cls._MAX_CONCURRENCY
+        cls._MULTIPART_THRESHOLD = multipart_threshold or cls._MULTIPART_THRESHOLD
+        cls._MULTIPART_CHUNKSIZE = multipart_chunksize or cls._MULTIPART_CHUNKSIZE
+        # NEW CREDENTIALS OR TUNING NEED A NEW SESSION
+        with cls._LOCK:
+            cls._PID = None
 
     @staticmethod
-    def _get_boto3_resource():
+    def _connect():
         """
-        GET AND CONFIGURE THE BOTO3 S3 API RESOURCE. THIS IS A "PRIVATE" METHOD
+        CREATE THE PROCESS' BOTO3 SESSION, CLIENT AND TRANSFER CONFIG ON FIRST USE. THIS IS A "PRIVATE" METHOD
         """
-        # CREATE A "SESSION" WITH BOTO3
+        if Bucket._PID == os.getpid():
+            return
+        with Bucket._LOCK:
+            if Bucket._PID == os.getpid():
+                return
+            # CREATE A "SESSION" WITH BOTO3
+            session = boto3.Session(
+                aws_access_key_id=Bucket._AWS_ACCESS_KEY_ID,
+                aws_secret_access_key=Bucket._AWS_SECRET_ACCESS_KEY,
+                aws_session_token=Bucket._AWS_SESSION_TOKEN
+            )
+            # ENOUGH POOLED CONNECTIONS FOR EVERY PART OF EVERY CONCURRENT TRANSFER
+            config = Config(max_pool_connections=2 * Bucket._MAX_CONCURRENCY,
+                            retries={'max_attempts': 5, 'mode': 'adaptive'})
+            Bucket._CLIENT = session.client('s3', endpoint_url=Bucket._ENDPOINT_URL, config=config)
+            Bucket._TRANSFER_CONFIG = TransferConfig(multipart_threshold=Bucket._MULTIPART_THRESHOLD,
+                                                     multipart_chunksize=Bucket._MULTIPART_CHUNKSIZE,
+                                                     max_concurrency=Bucket._MAX_CONCURRENCY,
+                                                     use_threads=True)
+            Bucket._PID = os.getpid()
 
-        _session = boto3.Session(
-            aws_access_key_id=Bucket._AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=Bucket._AWS_SECRET_ACCESS_KEY,
-            aws_session_token=Bucket._AWS_SESSION_TOKEN
-        )
-
-        # CREATE S3 RESOURCE
-        resource = _session.resource('s3', endpoint_url=Bucket._ENDPOINT_URL)
+    @staticmethod
+    def client():
+        """
+        GET THE SHARED BOTO3 S3 CLIENT. CLIENTS ARE THREAD SAFE
+        """
+        Bucket._connect()
+        return Bucket._CLIENT
 
-        return resource
+    @staticmethod
+    def max_concurrency() -> int:
+        """
+        GET THE NUMBER OF PARTS OR OBJECTS TRANSFERRED AT ONCE. CALLERS BATCHING OBJECTS FOR get_many/put_many
+        CAN USE IT AS THE BATCH SIZE
+        """
+        return Bucket._MAX_CONCURRENCY
 
     def _handle_boto3_client_error(self, e: ClientError, key=None):
         """
@@ -77,15 +131,15 @@ class Bucket:
             LEFT UP TO MIDDLEWARE TO DETERMINE AND (2) A DICT CONTAINING METADATA ON WHEN THE OBJECT WAS STORED
         """
 
-        # GET S3 resource
-        resource = Bucket._get_boto3_resource()
-        s3_bucket = resource.Object(self.bucket_name, key)
+        # GET S3 CLIENT
+        client = Bucket.client()
 
         try:
             if response_content_type:
-                response = s3_bucket.get(ResponseContentType=response_content_type)
+                response = client.get_object(Bucket=self.bucket_name, Key=key,
+                                             ResponseContentType=response_content_type)
             else:
-                response = s3_bucket.get()
+                response = client.get_object(Bucket=self.bucket_name, Key=key)
 
             data = response.get('Body').read()  # THE OBJECT DATA STORED
             metadata: Dict = response.get('Metadata')  # METADATA STORED WITH THE OBJECT
@@ -107,21 +161,22 @@ class Bucket:
         :return: A DICT CONTAINING THE RESPONSE FROM S3. IF AN EXCEPTION IS NOT THROWN, ASSUME PUT OPERATION WAS SUCCESSFUL.
         """
 
-        # GET RESOURCE
-        resource = Bucket._get_boto3_resource()
-        s3_bucket = resource.Object(self.bucket_name, key)
+        # GET S3 CLIENT
+        client = Bucket.client()
 
         # PUT IT
         try:
             if content_type:
-                response = s3_bucket.put(
+                response = client.put_object(
+                    Bucket=self.bucket_name,
                     Body=data,
                     ContentType=content_type,
                     Key=key,
                     Metadata=metadata
                 )
             else:
-                response = s3_bucket.put(
+                response = client.put_object(
+                    Bucket=self.bucket_name,
                     Body=data,
                     Key=key,
                     Metadata=metadata
@@ -139,12 +194,11 @@ class Bucket:
         :param key: A STRING THAT IS THE OBJECT'S KEY IDENTIFIER IN S3
         :return: THE RESPONSE FROM S3. IF NO EXCEPTION WAS THROWN, ASSUME DELETE OPERATION WAS SUCCESSFUL
         """
-        # GET S3 RESOURCE
-        resource = Bucket._get_boto3_resource()
-        s3_bucket = resource.Object(self.bucket_name, key)
+        # GET S3 CLIENT
+        client = Bucket.client()
 
         try:
-            response = s3_bucket.delete()
+            response = client.delete_object(Bucket=self.bucket_name, Key=key)
             return response
 
         # BOTO RAISES ONLY ONE ERROR TYPE THAT THEN MUST BE PROCESSES TO GET THE CODE
@@ -153,7 +207,8 @@ class Bucket:
 
     def upload_file(self, local_filepath: str, key: str) -> Dict:
         """
-        UPLOAD A LOCAL FILE TO THE BUCKET. TRANSPARENTLY MANAGES MULTIPART UPLOADS.
+        UPLOAD A LOCAL FILE TO THE BUCKET. TRANSPARENTLY MANAGES MULTIPART UPLOADS, SENDING UP TO
+        MAX_CONCURRENCY PARTS AT ONCE.
 
         :param local_filepath: THE ABSOLUTE FILEPATH OF THE FILE TO STORE
         :param key: THE KEY TO STORE THE FILE UNDER IN THE BUCKET
@@ -161,12 +216,11 @@ class Bucket:
             COMPLETED SUCCESSFULLY
         """
 
-        # GET S3 RESOURCE
-        resource = Bucket._get_boto3_resource()
-        s3_bucket = resource.Object(self.bucket_name, key)
+        # GET S3 CLIENT
+        client = Bucket.client()
 
         try:
-            response = s3_bucket.upload_file(local_filepath)
+            response = client.upload_file(local_filepath, self.bucket_name, key, Config=Bucket._TRANSFER_CONFIG)
             return response
 
             # BOTO RAISES ONLY ONE ERROR TYPE THAT THEN MUST BE PROCESSES TO GET THE CODE
@@ -175,21 +229,47 @@ class Bucket:
 
     def download_file(self, key: str, local_filepath: str) -> Dict:
         """
-        DOWNLOAD AN OBJECT FROM THE BUCKET TO A LOCAL FILE. TRANSPARENTLY MANAGES MULTIPART DOWNLOADS.
+        DOWNLOAD AN OBJECT FROM THE BUCKET TO A LOCAL FILE. TRANSPARENTLY MANAGES MULTIPART DOWNLOADS, FETCHING UP
+        TO MAX_CONCURRENCY RANGES AT ONCE.
 
         :param key: THE KEY THAT IDENTIFIES THE OBJECT TO DOWNLOAD
         :param local_filepath: THE ABSOLUTE FILEPATH TO STORE THE OBJECT TO
         :return: A DICT CONTAINING THE RESPONSE FROM S3. IF NO EXCEPTION IS THROWN, ASSUME OPERATION
             COMPLETED SUCCESSFULLY
         """
-        # GET S3 RESOURCE
-        resource = Bucket._get_boto3_resource()
-        s3_bucket = resource.Object(self.bucket_name, key)
+        # GET S3 CLIENT
+        client = Bucket.client()
 
         try:
-            response = s3_bucket.download_file(local_filepath)
+            response = client.download_file(self.bucket_name, key, local_filepath, Config=Bucket._TRANSFER_CONFIG)
             return response
 
             # BOTO RAISES ONLY ONE ERROR TYPE THAT THEN MUST BE PROCESSES TO GET THE CODE
         except ClientError as e:
             self._handle_boto3_client_error(e, key=key)
+
+    def get_many(self, keys: List[str], response_content_type: str = None) -> Dict[str, tuple]:
+        """
+        GET SEVERAL OBJECTS FROM THE BUCKET, UP TO MAX_CONCURRENCY AT ONCE
+
+        :param keys: THE KEYS IN S3 OF THE OBJECTS TO GET
+        :param response_content_type: THE CONTENT TYPE TO ENFORCE ON THE RESPONSES
+        :return: A DICT MAPPING EACH KEY TO THE (DATA, METADATA) TWO-TUPLE RETURNED BY get().
+            THE FIRST EXCEPTION RAISED BY ANY GET IS RAISED
+        """
+        with ThreadPoolExecutor(Bucket._MAX_CONCURRENCY) as pool:
+            results = pool.map(lambda key: self.get(key, response_content_type), keys)
+            return dict(zip(keys, results))
+
+    def put_many(self, objects: Dict[str, Union[str, bytes]], content_type: str = None, metadata: Dict = {}) -> Dict[str, Dict]:
+        """
+        PUT SEVERAL OBJECTS INTO THE BUCKET, UP TO MAX_CONCURRENCY AT ONCE
+
+        :param objects: A DICT MAPPING THE KEY TO STORE EACH OBJECT UNDER TO ITS DATA
+        :param content_type: THE MIME TYPE TO STORE THE OBJECTS AS
+        :param metadata: A DICT CONTAINING METADATA TO STORE WITH EACH OBJECT. VALUES _MUST_ BE STRINGS.
+        :return: A DICT MAPPING EACH KEY TO THE RESPONSE FROM S3. THE FIRST EXCEPTION RAISED BY ANY PUT IS RAISED
+        """
+        with ThreadPoolExecutor(Bucket._MAX_CONCURRENCY) as pool:
+            results = pool.map(lambda item: self.put(item[0], item[1], content_type, metadata), objects.items())
+            return dict(zip(objects, results))
@@ -0,0 +1,142 @@
+"""
+Local stand-in for the S3 compatible object storage, for offline testing of s3_bucket.Bucket.
+
+Serves an in-memory S3 api using moto's server (pip install "moto[server]").
+Point the app at it with:
+
+    JIGGY_STORAGE_ENDPOINT_URL=http://localhost:5055 JIGGY_STORAGE_KEY_ID=standin JIGGY_STORAGE_KEY_SECRET=standin
+
+usage: python s3_standin.py [--port 5055] [--bucket jiggy-assets]
+       python s3_standin.py --check
+
+--check starts the stand-in, runs the Bucket and index artifact checks against it
+and exits non-zero on the first failure.
+"""
+
+import os
+import zlib
+import argparse
+import tempfile
+from time import time, sleep
+from loguru import logger
+from moto.server import ThreadedMotoServer
+
+import s3_bucket as S3
+import index_artifact
+from exceptions import ArtifactIntegrityError
+
+
+MB = 1024 * 1024
+
+
+def check_bucket(bucket : S3.Bucket) -> None:
+    """
+    check the Bucket operations against the stand-in
+    """
+    assert S3.Bucket.client() is S3.Bucket.client(), "client is not shared"
+
+    bucket.put("check/x", b"hello", metadata={"a": "1"})
+    data, metadata = bucket.get("check/x")
+    assert data == b"hello" and metadata == {"a": "1"}, "get returned what put stored"
+
+    objects = {f"check/many-{i}": f"value {i}" for i in range(3 * S3.Bucket._MAX_CONCURRENCY)}
+    assert set(bucket.put_many(objects)) == set(objects), "put_many responses"
+    got = bucket.get_many(list(objects))
+    assert list(got) == list(objects), "get_many keeps key order"
+    assert all(got[key][0].decode() == value for key, value in objects.items()), "get_many data"
+
+    try:
+        bucket.get("check/missing")
+        raise AssertionError("get of a missing key succeeded")
+    except S3.Exceptions.NoSuchKey:
+        pass
+
+    # large enough to be transferred in parts
+    size = S3.Bucket._MULTIPART_THRESHOLD + S3.Bucket._MULTIPART_CHUNKSIZE // 2
+    with tempfile.TemporaryDirectory() as tmp:
+        upload = os.path.join(tmp, "upload")
+        download = os.path.join(tmp, "download")
+        data = os.urandom(size)
+        with open(upload, "wb") as f:
+            f.write(data)
+        t0 = time()
+        bucket.upload_file(upload, "check/big")
+        bucket.download_file("check/big", download)
+        with open(download, "rb") as f:
+            assert f.read() == data, "multipart round trip"
+        etag = S3.Bucket.client().head_object(Bucket=bucket.bucket_name, Key="check/big")["ETag"]
+        assert "-" in etag, "upload_file didn't use multipart"
+        logger.info(f"check: {size} byte multipart round trip in {time() - t0:.2f}s")
+
+    for key in ["check/x", "check/big", *objects]:
+        bucket.delete(key)
+
+
+def check_artifact(bucket : S3.Bucket) -> None:
+    """
+    check index artifact round trips and corruption detection against the stand-in
+    """
+    index_artifact.ARTIFACT_CHUNK_SIZE = MB
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot = os.path.join(tmp, "snapshot")
+        download = os.path.join(tmp, "download")
+        # more chunks than are transferred at once, partly compressible, with a short last chunk
+        data = os.urandom(2 * MB) + bytes((S3.Bucket.max_concurrency() + 1) * MB) + os.urandom(1000)
+        with open(snapshot, "wb") as f:
+            f.write(data)
+        key = index_artifact.upload(bucket, snapshot, "check/artifact")
+        manifest = index_artifact.download(bucket, key, download)
+        with open(download, "rb") as f:
+            assert f.read() == data, "artifact round trip"
+        assert len(manifest["chunks"]) > S3.Bucket.max_concurrency(), "artifact chunk batches"
+
+        with open(snapshot, "ab") as f:
+            f.write(b"more")
+        assert index_artifact.upload(bucket, snapshot, "check/artifact") != key, "artifact prefixes aren't unique"
+
+        chunk = manifest["chunks"][2]
+        for corrupt in [zlib.compress(os.urandom(chunk["size"])), b"not zlib"]:
+            bucket.put(chunk["key"], corrupt)
+            try:
+                index_artifact.download(bucket, key, download)
+                raise AssertionError("corrupt artifact chunk was accepted")
+            except ArtifactIntegrityError as e:
+                logger.info(f"check: {e}")
+            assert not os.path.exists(f"{download}.part"), "partial download left behind"
+            with open(download, "rb") as f:
+                assert f.read() == data, "verified download was replaced"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port",   type=int, default=5055)
+    parser.add_argument("--bucket", type=str, default="jiggy-assets")
+    parser.add_argument("--check",  action="store_true", help="check s3_bucket.Bucket against the stand-in and exit")
+    args = parser.parse_args()
+
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    server = ThreadedMotoServer(port=args.port)
+    server.start()
+    endpoint_url = f"http://localhost:{args.port}"
+
+    # small parts so the multipart path is checked without large files
+    S3.Bucket.prepare("standin", "standin", endpoint_url=endpoint_url,
+                      multipart_threshold=5 * MB, multipart_chunksize=5 * MB)
+    S3.Bucket.client().create_bucket(Bucket=args.bucket)
+    logger.info(f"s3 stand-in on {endpoint_url} with bucket {args.bucket}")
+
+    if args.check:
+        check_bucket(S3.Bucket(args.bucket))
+        check_artifact(S3.Bucket(args.bucket))
+        logger.info("check: ok")
+        server.stop()
+        return
+    try:
+        while True:
+            sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
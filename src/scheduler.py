@@ -0,0 +1,128 @@
+#  LLM API request scheduler
+#  Copyright (C) 2022 William S. Kish
+#
+#  Every completion request reserves request and token budget from the process-wide
+#  scheduler before calling the api.  Reservations are tracked over a sliding one minute
+#  window against the configured quotas, and waiting requests are served in priority
+#  order so interactive replies are never stuck behind background work.
+
+import os
+import enum
+import heapq
+import itertools
+import threading
+from time import monotonic
+from collections import deque
+from loguru import logger
+
+
+# Quota Config
+OPENAI_REQUESTS_PER_MINUTE = int(os.environ.get("MASSGPT_OPENAI_RPM", 3000))
+OPENAI_TOKENS_PER_MINUTE   = int(os.environ.get("MASSGPT_OPENAI_TPM", 250000))
+
+WINDOW = 60   # seconds
+
+
+class Priority(enum.IntEnum):
+    """
+    Request priority lanes, served in order
+    """
+    interactive = 0     # replies to user messages
+    url_summary = 1     # user-requested url summaries
+    background  = 2     # experiments, compaction and other background jobs
+
+
+
+class RequestScheduler:
+    """
+    Reserve budget against requests-per-minute and tokens-per-minute quotas.
+    acquire() blocks until the request can be made within the quotas and no
+    higher priority (or earlier same priority) request is waiting.
+    """
+    def __init__(self,
+                 requests_per_minute : int,
+                 tokens_per_minute   : int) -> "RequestScheduler":
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute   = tokens_per_minute
+        self._cond    = threading.Condition()
+        self._window  = deque()     # (timestamp, tokens) of reservations made in the last WINDOW
+        self._tokens  = 0           # total tokens reserved in the window
+        self._waiting = []          # heap of (priority, seq) of waiting requests
+        self._seq     = itertools.count()
+        self._paused_until = 0
+
+    def _expire(self, now : float) -> None:
+        while self._window and self._window[0][0] <= now - WINDOW:
+            self._tokens -= self._window.popleft()[1]
+
+    def _wait_time(self, tokens : int, now : float) -> float:
+        """
+        return the seconds until tokens can be reserved, 0 if they can be reserved now
+        """
+        if now < self._paused_until:
+            return self._paused_until - now
+        excess_requests = len(self._window) + 1 - self.requests_per_minute
+        excess_tokens   = self._tokens + tokens - self.tokens_per_minute
+        if excess_requests <= 0 and excess_tokens <= 0:
+            return 0
+        # wait for enough of the oldest reservations to leave the window
+        freed = 0
+        for count, (t, n) in enumerate(self._window, 1):
+            freed += n
+            if count >= excess_requests and freed >= excess_tokens:
+                return t + WINDOW - now
+        return WINDOW
+
+    def acquire(self, tokens : int, priority : Priority = Priority.background) -> None:
+        """
+        block until tokens (prompt tokens + max completion tokens) can be reserved
+        for a request at the specified priority, then reserve them.
+        """
+        # a single request can never reserve more than the entire quota
+        tokens = min(tokens, self.tokens_per_minute)
+        t0 = monotonic()
+        entry = (priority, next(self._seq))
+        with self._cond:
+            heapq.heappush(self._waiting, entry)
+            self._cond.notify_all()
+            try:
+                while True:
+                    now = monotonic()
+                    self._expire(now)
+                    wait = None
+                    if self._waiting[0] == entry:
+                        wait = self._wait_time(tokens, now)
+                        if wait <= 0:
+                            break
+                    self._cond.wait(wait)
+            finally:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+            self._window.append((now, tokens))
+            self._tokens += tokens
+        dt = monotonic() - t0
+        if dt > 0.1:
+            logger.info(f"scheduler: {priority.name} request waited {dt:.2f}s for {tokens} tokens")
+
+    def partition(self, processes : int) -> None:
+        """
+        limit this process to an equal share of the quotas when the api key
+        is shared by the specified number of processes
+        """
+        with self._cond:
+            self.requests_per_minute = max(1, self.requests_per_minute // processes)
+            self.tokens_per_minute   = max(1, self.tokens_per_minute // processes)
+
+    def backoff(self, seconds : float) -> None:
+        """
+        pause all lanes for the specified seconds, e.g. after the api reports a rate limit
+        """
+        with self._cond:
+            self._paused_until = max(self._paused_until, monotonic() + seconds)
+            self._cond.notify_all()
+
+
+
+scheduler = RequestScheduler(requests_per_minute = OPENAI_REQUESTS_PER_MINUTE,
+                             tokens_per_minute   = OPENAI_TOKENS_PER_MINUTE)
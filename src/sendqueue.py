@@ -0,0 +1,166 @@
+#  Outbound Telegram rate limiting
+#  Copyright (C) 2022 William S. Kish
+#
+#  Every request the bot sends to a chat passes through SendRateLimiter, which holds it
+#  until the global and per-chat token buckets have room, so bursts of replies are
+#  spread out under telegram's flood limits instead of earning flood bans.
+#  A request that still gets RetryAfter pauses its chat for the time telegram asks
+#  and is retried.
+
+import os
+import asyncio
+from time import monotonic
+from loguru import logger
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from lru import LRUCache
+import metrics
+
+
+# Telegram Rate Config (messages per second)
+TELEGRAM_GLOBAL_RATE  = float(os.environ.get("MASSGPT_TELEGRAM_GLOBAL_RATE", 30))
+TELEGRAM_CHAT_RATE    = float(os.environ.get("MASSGPT_TELEGRAM_CHAT_RATE", 1))          # private chats
+TELEGRAM_GROUP_RATE   = float(os.environ.get("MASSGPT_TELEGRAM_GROUP_RATE", 20/60))     # groups and channels
+TELEGRAM_CHAT_BURST   = int(os.environ.get("MASSGPT_TELEGRAM_CHAT_BURST", 3))
+TELEGRAM_MAX_RETRIES  = int(os.environ.get("MASSGPT_TELEGRAM_MAX_RETRIES", 3))
+
+# longest text telegram accepts in one message
+TELEGRAM_MAX_MESSAGE = 4096
+
+
+class TokenBucket:
+    """
+    A token bucket refilled at rate tokens per second up to burst tokens.
+    reserve() takes a token even if the bucket is empty and returns how long the
+    caller must wait for it, so callers are served in the order they reserve.
+    """
+    def __init__(self, rate : float, burst : int) -> "TokenBucket":
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = monotonic()
+
+    def _refill(self, now : float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self) -> float:
+        """
+        take a token, returning the seconds until it is available
+        """
+        self._refill(monotonic())
+        self._tokens -= 1
+        return 0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def available(self) -> bool:
+        """
+        return True if a token is available now, without taking it
+        """
+        self._refill(monotonic())
+        return self._tokens >= 1
+
+    def pause(self, seconds : float) -> None:
+        """
+        make the next token available no sooner than seconds from now
+        """
+        self._refill(monotonic())
+        self._tokens = min(self._tokens, 1 - seconds * self.rate)
+
+
+
+class SendRateLimiter(BaseRateLimiter):
+    """
+    Throttle requests to telegram that have a chat_id with a bucket per chat and a
+    bucket shared by all chats, retrying requests that get RetryAfter.
+    Requests without a chat_id are not throttled.
+    """
+    def __init__(self, max_chats : int = 10000) -> "SendRateLimiter":
+        self.overall = TokenBucket(TELEGRAM_GLOBAL_RATE, max(1, int(TELEGRAM_GLOBAL_RATE)))
+        self._chats = LRUCache(max_chats)   # chat_id -> TokenBucket
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def partition(self, processes : int) -> None:
+        """
+        limit this process to an equal share of the global rate when the bot
+        token is shared by the specified number of processes
+        """
+        self.overall = TokenBucket(TELEGRAM_GLOBAL_RATE / processes,
+                                   max(1, int(TELEGRAM_GLOBAL_RATE / processes)))
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # group and channel ids are negative; channels may also be addressed by @username
+            group = isinstance(chat_id, str) or chat_id < 0
+            bucket = TokenBucket(TELEGRAM_GROUP_RATE if group else TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST)
+            self._chats.put(chat_id, bucket)
+        return bucket
+
+    def ready(self, chat_id) -> bool:
+        """
+        return True if a request to chat_id would be sent without waiting, so optional
+        requests such as the intermediate edits of a streaming reply can be skipped
+        instead of queued behind the chat's other requests
+        """
+        return self._chat_bucket(self._chat_key(chat_id)).available() and self.overall.available()
+
+    @staticmethod
+    def _chat_key(chat_id):
+        if isinstance(chat_id, str) and chat_id.lstrip("-").isdigit():
+            return int(chat_id)
+        return chat_id
+
+    async def _wait(self, bucket : TokenBucket) -> None:
+        delay = bucket.reserve()
+        if delay:
+            metrics.observe("telegram_wait", delay)
+            await asyncio.sleep(delay)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            return await callback(*args, **kwargs)
+        chat_id = self._chat_key(chat_id)
+        chat = self._chat_bucket(chat_id)
+        for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+            # wait for the chat before taking a global token so a busy chat doesn't hold up the others
+            await self._wait(chat)
+            await self._wait(self.overall)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                metrics.TELEGRAM_RETRY_AFTER.inc()
+                if attempt == TELEGRAM_MAX_RETRIES:
+                    raise
+                logger.warning(f"telegram: {endpoint} to {chat_id} retry after {e.retry_after}s")
+                chat.pause(e.retry_after)
+
+
+
+def coalesce(parts : list[str], max_len : int = TELEGRAM_MAX_MESSAGE) -> list[str]:
+    """
+    join consecutive parts into as few messages of at most max_len characters as
+    possible.  Parts longer than max_len are split.
+    """
+    messages = []
+    text = ""
+    for part in parts:
+        while len(part) > max_len:
+            head, part = part[:max_len], part[max_len:]
+            if text:
+                messages.append(text)
+                text = ""
+            messages.append(head)
+        if text and len(text) + 1 + len(part) > max_len:
+            messages.append(text)
+            text = ""
+        text = f"{text}\n{part}" if text else part
+    if text:
+        messages.append(text)
+    return messages
@@ -0,0 +1,102 @@
+#  Startup sequencing
+#  Copyright (C) 2022 William S. Kish
+#
+#  Heavy components (tokenizer, embedding model) are LazyComponents that initialize
+#  on first use or when the startup sequence warms them, recording how long each took.
+#  The process is marked ready once the components needed to answer messages are
+#  available.  Set MASSGPT_HEALTH_PORT to serve /ready and /healthz for probes.
+
+import os
+import threading
+from time import perf_counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from loguru import logger
+
+import metrics
+
+
+# Health Config
+HEALTH_PORT = int(os.environ.get("MASSGPT_HEALTH_PORT", 0))   # 0 disables the endpoint
+
+
+# component name -> seconds taken to initialize
+timings = {}
+
+_ready = threading.Event()
+
+
+def record(name : str, seconds : float) -> None:
+    """
+    record the startup time of the named component
+    """
+    timings[name] = seconds
+    metrics.STARTUP_SECONDS.labels(name).set(seconds)
+    logger.info(f"startup: {name} {seconds:.2f}s")
+
+
+class LazyComponent:
+    """
+    A component created by factory() on first call, or ahead of time by init().
+    Concurrent callers wait for the one initialization.
+    """
+    def __init__(self, name : str, factory) -> "LazyComponent":
+        self.name = name
+        self.factory = factory
+        self._instance = None
+        self._lock = threading.Lock()
+
+    def init(self) -> None:
+        if self._instance is not None:
+            return
+        with self._lock:
+            if self._instance is None:
+                t0 = perf_counter()
+                self._instance = self.factory()
+                record(self.name, perf_counter() - t0)
+
+    def loaded(self) -> bool:
+        return self._instance is not None
+
+    def __call__(self):
+        if self._instance is None:
+            self.init()
+        return self._instance
+
+
+
+def set_ready() -> None:
+    _ready.set()
+    metrics.READY.set(1)
+    logger.info(f"startup: ready  ({', '.join(f'{k} {v:.2f}s' for k, v in timings.items())})")
+
+def is_ready() -> bool:
+    return _ready.is_set()
+
+
+
+class HealthHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/healthz":
+            status = 200
+        elif self.path == "/ready":
+            status = 200 if is_ready() else 503
+        else:
+            status = 404
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def start_health_server(port_offset : int = 0) -> None:
+    """
+    serve /healthz (process is up) and /ready (bot can answer) on HEALTH_PORT + port_offset
+    if configured.  Worker processes each serve their own state on consecutive ports.
+    """
+    if HEALTH_PORT:
+        server = ThreadingHTTPServer(("0.0.0.0", HEALTH_PORT + port_offset), HealthHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logger.info(f"health on :{HEALTH_PORT + port_offset}/ready")
@@ -14,7 +14,6 @@ from exceptions import *
 # have found that marking truncated text as truncated stops the model from trying
 # to complete the missing text instead of summarizing it as requested
 TRUNCATED = "<TRUNCATED>"
-TRUNCATED_LEN = token_len(TRUNCATED)
 
 class SubPrompt:
     """
@@ -29,7 +28,12 @@ class SubPrompt:
     The combined token count is estimated (not computed) so can sometimes overestimate the
     actual token count by 1 token.  Tests on random strings show this occurs less
     than 1% of the time.
+
+    The token count of a SubPrompt created without max_tokens is computed on first use.
+
+    embedding is the unit embedding vector of the text where it has been embedded.
     """
+    embedding = None
 
     def truncate(self, max_tokens, precise=False):
         if precise == True:
@@ -39,7 +43,7 @@ class SubPrompt:
         # TODO: consider option to truncating at sentence boundaries.
         if self.tokens <= max_tokens:
             return
-        split_point = int(len(self.text) * (max_tokens-TRUNCATED_LEN) / self.tokens)
+        split_point = int(len(self.text) * (max_tokens-token_len(TRUNCATED)) / self.tokens)
         while not self.text[split_point].isspace():            
             split_point -= 1
         self.text = self.text[:split_point] + TRUNCATED
@@ -47,7 +51,32 @@ class SubPrompt:
         if self.tokens > max_tokens:
             self.truncate(max_tokens*.95)
         
-        
+
+    def split(self, max_tokens) -> list["SubPrompt"]:
+        """
+        split the SubPrompt into consecutive SubPrompts of at most max_tokens each.
+        Split points are estimated from the average characters per token and
+        moved back to the preceding whitespace where possible.
+        """
+        if self.tokens <= max_tokens:
+            return [self]
+        chars = max(1, int(len(self.text) * max_tokens / self.tokens))
+        chunks = []
+        start = 0
+        while start < len(self.text):
+            end = min(start + chars, len(self.text))
+            if end < len(self.text):
+                split_point = end
+                while split_point > start and not self.text[split_point].isspace():
+                    split_point -= 1
+                if split_point > start:
+                    end = split_point
+            chunk = SubPrompt(self.text[start:end])
+            # the token density of this chunk may be higher than average
+            chunks.extend(chunk.split(max_tokens) if chunk.tokens > max_tokens else [chunk])
+            start = end
+        return chunks
+
     def __init__(self, text: str, max_tokens=None, truncate=False, precise=False, tokens=None) -> "SubPrompt":
         """
         Create a subprompt from the specified string.
@@ -60,15 +89,22 @@ class SubPrompt:
         """
         if precise == True:
             raise Exception("precise truncation is not yet implemented")
-        if tokens is None:
-            tokens = token_len(text)
         self.text = text
-        self.tokens = tokens
-        if max_tokens is not None and tokens > max_tokens:
+        self._tokens = tokens
+        if max_tokens is not None and self.tokens > max_tokens:
             if not truncate: 
                 raise MaximumTokenLimit
             self.truncate(max_tokens, precise=precise)
 
+    @property
+    def tokens(self) -> int:
+        if self._tokens is None:
+            self._tokens = token_len(self.text)
+        return self._tokens
+
+    @tokens.setter
+    def tokens(self, tokens : int) -> None:
+        self._tokens = tokens
     
 
     def __len__(self) -> int:        
@@ -1,14 +1,22 @@
 
 
-from transformers import GPT2Tokenizer
+from startup import LazyComponent
 
 
-tokenizer = GPT2Tokenizer.from_pretrained("gpt2")
+def _load_tokenizer():
+    from transformers import GPT2Tokenizer
+    return GPT2Tokenizer.from_pretrained("gpt2")
+
+# loaded on first use; importing transformers alone takes seconds
+tokenizer = LazyComponent("tokenizer", _load_tokenizer)
 
 def token_len(text : str) -> int:
     """
     return number of tokens in text per gpt2 tokenizer
     """
-    return len(tokenizer(text)['input_ids'])
+    return len(tokenizer()(text)['input_ids'])
 
 
+# rough number of characters per token for english text,
+# used where a running token estimate is good enough
+CHARS_PER_TOKEN = 4
@@ -0,0 +1,116 @@
+#  Webhook mode
+#  Copyright (C) 2022 William S. Kish
+#
+#  Telegram posts updates to WEBHOOK_URL, which a reverse proxy forwards to the local
+#  endpoint on WEBHOOK_PORT.  The listening socket is bound once and shared by
+#  WEBHOOK_WORKERS forked worker processes, each running its own copy of the bot
+#  application, so the kernel spreads the updates across the workers.
+
+import os
+import sys
+import json
+import signal
+import asyncio
+from loguru import logger
+from telegram import Bot, Update
+from telegram.ext import Application
+import tornado.web
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.process import fork_processes
+
+
+# Webhook Config
+WEBHOOK_URL     = os.environ.get("MASSGPT_WEBHOOK_URL")            # public url telegram posts updates to
+WEBHOOK_LISTEN  = os.environ.get("MASSGPT_WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT    = int(os.environ.get("MASSGPT_WEBHOOK_PORT", 8080))
+WEBHOOK_PATH    = os.environ.get("MASSGPT_WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET  = os.environ.get("MASSGPT_WEBHOOK_SECRET")         # checked against X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_WORKERS = int(os.environ.get("MASSGPT_WEBHOOK_WORKERS", os.cpu_count() or 1))
+
+
+class UpdateHandler(tornado.web.RequestHandler):
+    """
+    accept an update posted by telegram and queue it for the application
+    """
+    def initialize(self, bot_application : Application) -> None:
+        self.bot_application = bot_application
+
+    async def post(self) -> None:
+        if WEBHOOK_SECRET and self.request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            self.set_status(403)
+            return
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.bot_application.bot)
+        except ValueError:
+            self.set_status(400)
+            return
+        await self.bot_application.update_queue.put(update)
+        self.set_status(200)
+
+
+
+async def set_webhook(token : str) -> None:
+    """
+    point telegram at WEBHOOK_URL; done once by the parent process
+    """
+    async with Bot(token) as bot:
+        await bot.set_webhook(url          = WEBHOOK_URL + WEBHOOK_PATH,
+                              secret_token = WEBHOOK_SECRET)
+    logger.info(f"webhook: {WEBHOOK_URL}{WEBHOOK_PATH}")
+
+
+async def serve(application : Application, sockets : list) -> None:
+    """
+    run the application, taking updates from the shared sockets until SIGTERM or SIGINT
+    """
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+    server = HTTPServer(tornado.web.Application([(WEBHOOK_PATH, UpdateHandler, {"bot_application": application})]))
+    server.add_sockets(sockets)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    server.stop()
+    await application.stop()
+    await application.shutdown()
+
+
+def _terminate_workers(signum, frame) -> None:
+    """
+    SIGTERM handler for the parent process: pass the signal on to the workers and exit
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    os.killpg(os.getpgid(0), signal.SIGTERM)
+    sys.exit(0)
+
+
+def run(application : Application, worker_init = None) -> None:
+    """
+    serve the application on the webhook endpoint in WEBHOOK_WORKERS processes.
+    worker_init(worker_id) is called in each worker process after it is forked.
+    The parent process restarts workers that exit unexpectedly.
+    """
+    asyncio.run(set_webhook(application.bot.token))
+    sockets = bind_sockets(WEBHOOK_PORT, WEBHOOK_LISTEN)
+    logger.info(f"webhook: {WEBHOOK_WORKERS} workers on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    if WEBHOOK_WORKERS > 1:
+        # lead a process group of our own so _terminate_workers only signals us and our
+        # workers, not the shell or supervisor we were started from
+        if os.getpgid(0) != os.getpid():
+            os.setpgrp()
+        signal.signal(signal.SIGTERM, _terminate_workers)
+        worker_id = fork_processes(WEBHOOK_WORKERS, max_restarts=100)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    else:
+        worker_id = 0
+    if worker_init:
+        worker_init(worker_id)
+    asyncio.run(serve(application, sockets))